@@ -1,13 +1,39 @@
 #!/usr/bin/env python3
 import os
+import sys
+import csv
+import glob
 import re
 import json
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import asyncio
+import importlib.util
+import multiprocessing
+import time
+import random
+import hashlib
+import argparse
+import queue
+import atexit
+import sqlite3
+import signal
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields
+from email.utils import parsedate_to_datetime
+from types import MappingProxyType
 import httpx
 import uvloop
 from aiogram import Bot, Dispatcher, types, F, Router
-from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import SendChatAction
+from aiogram.filters import BaseFilter, Command, CommandObject
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -15,32 +41,91 @@ from aiogram.types import (
     InlineKeyboardButton
 )
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
-from aiohttp import web
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
 from dotenv import load_dotenv
 
-uvloop.install()
+load_dotenv('/etc/secrets/bot_env')
+
+DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
+MAINTENANCE = os.getenv('MAINTENANCE', 'False').lower() == 'true'
+
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.1))
+SAMPLED_LOGGERS = frozenset(("aiogram.event", "aiohttp.access", "httpx"))
+LOG_FIELDS = ("chat_id", "update_id", "stage", "latency", "worker")
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение и поля из extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for name in LOG_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Пропускает долю массовых INFO-событий; предупреждения и ошибки пишутся всегда"""
+
+    def __init__(self, rate: float, loggers: frozenset):
+        super().__init__()
+        self.rate = rate
+        self.loggers = loggers
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1 or record.levelno > logging.INFO:
+            return True
+        if record.name in self.loggers or getattr(record, "sampled", False):
+            return random.random() < self.rate
+        return True
+
+log_listener = None
+
+def setup_logging(debug: bool):
+    global log_listener
+    if log_listener is not None:
+        return
+    # Вывод пишет отдельный поток: зависший stdout не останавливает цикл событий
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler()
+    if debug:
+        output.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    else:
+        output.setFormatter(JsonFormatter())
+    handler = QueueHandler(records)
+    handler.addFilter(SamplingFilter(1.0 if debug else LOG_SAMPLE_RATE, SAMPLED_LOGGERS))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(logging.INFO)
+    log_listener = QueueListener(records, output)
+    log_listener.start()
+    atexit.register(log_listener.stop)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
 logger = logging.getLogger(__name__)
 
-load_dotenv('/etc/secrets/bot_env')
+REQUIRED_KEYS = ('TELEGRAM_BOT_TOKEN', 'YANDEX_API_KEY', 'YANDEX_FOLDER_ID', 'WEBHOOK_URL')
+BATCH_REQUIRED_KEYS = ('YANDEX_API_KEY', 'YANDEX_FOLDER_ID')
 
-REQUIRED_KEYS = ['TELEGRAM_BOT_TOKEN', 'YANDEX_API_KEY', 'YANDEX_FOLDER_ID', 'WEBHOOK_URL']
-for key in REQUIRED_KEYS:
-    if not os.getenv(key):
-        logger.error(f"Отсутствует обязательная переменная: {key}")
+def configure(required_keys: tuple = REQUIRED_KEYS):
+    # Импорт модуля ничего не проверяет и не создаёт: это делает точка входа один раз при старте
+    setup_logging(DEBUG)
+    missing = [key for key in required_keys if not os.getenv(key)]
+    for key in missing:
+        logger.error("Отсутствует обязательная переменная: %s", key)
+    if missing:
         raise SystemExit(1)
+    logger.info("Режимы работы: DEBUG=%s, MAINTENANCE=%s", DEBUG, MAINTENANCE)
 
-DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
-MAINTENANCE = os.getenv('MAINTENANCE', 'False').lower() == 'true'
-logger.info(f"Режимы работы: DEBUG={DEBUG}, MAINTENANCE={MAINTENANCE}")
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
 
-bot = Bot(token=os.getenv('TELEGRAM_BOT_TOKEN'))
-dp = Dispatcher()
-app = web.Application()
+router = Router()
+bot = None
+dp = None
 
 YANDEX_API_KEY = os.getenv('YANDEX_API_KEY')
 YANDEX_FOLDER_ID = os.getenv('YANDEX_FOLDER_ID')
@@ -48,8 +133,81 @@ CHANNEL_LINK = os.getenv('CHANNEL_LINK', "https://t.me/ai_kitchen_channel")
 
 MAX_RETRIES = 3
 REQUEST_DELAY = 1
+RETRY_MAX_DELAY = 30
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+RETRYABLE_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+YANDEX_RPS = float(os.getenv('YANDEX_RPS', 10))
+YANDEX_BURST = float(os.getenv('YANDEX_BURST', 10))
+TELEGRAM_GLOBAL_RPS = float(os.getenv('TELEGRAM_GLOBAL_RPS', 30))
+TELEGRAM_CHAT_RPS = float(os.getenv('TELEGRAM_CHAT_RPS', 1))
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', 3))
+
+YANDEX_GPT_URL = os.getenv('YANDEX_GPT_URL', "https://llm.api.cloud.yandex.net/foundationModels/v1/completion")
+YANDEX_HTTP2 = os.getenv('YANDEX_HTTP2', 'True').lower() == 'true'
+YANDEX_MAX_CONNECTIONS = int(os.getenv('YANDEX_MAX_CONNECTIONS', 20))
+YANDEX_MAX_KEEPALIVE = int(os.getenv('YANDEX_MAX_KEEPALIVE', 10))
+YANDEX_KEEPALIVE_EXPIRY = float(os.getenv('YANDEX_KEEPALIVE_EXPIRY', 60))
+YANDEX_CONNECT_TIMEOUT = float(os.getenv('YANDEX_CONNECT_TIMEOUT', 5))
+YANDEX_READ_TIMEOUT = float(os.getenv('YANDEX_READ_TIMEOUT', 90))
+YANDEX_POOL_TIMEOUT = float(os.getenv('YANDEX_POOL_TIMEOUT', 30))
+
+yandex_client = None
+
+YANDEX_MODEL = os.getenv('YANDEX_MODEL', 'yandexgpt-lite')
+YANDEX_FALLBACK_MODEL = os.getenv('YANDEX_FALLBACK_MODEL', 'yandexgpt' if YANDEX_MODEL == 'yandexgpt-lite' else 'yandexgpt-lite')
+MODEL_LATENCY_BUDGET = float(os.getenv('MODEL_LATENCY_BUDGET', 20))
+MODEL_ERROR_BUDGET = float(os.getenv('MODEL_ERROR_BUDGET', 0.2))
+MODEL_WINDOW = int(os.getenv('MODEL_WINDOW', 200))
+MODEL_MIN_SAMPLES = 20
+MODEL_SAMPLE_TTL = float(os.getenv('MODEL_SAMPLE_TTL', 300))
+MODEL_PROBE_RATE = float(os.getenv('MODEL_PROBE_RATE', 0.05))
+HEDGE_MAX_RATE = float(os.getenv('HEDGE_MAX_RATE', 0.05))
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 3))
+
+YANDEX_STREAM = os.getenv('YANDEX_STREAM', 'False').lower() == 'true'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.5))
+TELEGRAM_MESSAGE_LIMIT = 4000
 
-user_states = {}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+RECIPE_CACHE_SIZE = int(os.getenv('RECIPE_CACHE_SIZE', 1000))
+RECIPE_CACHE_TTL = float(os.getenv('RECIPE_CACHE_TTL', 6 * 3600))
+RECIPE_CACHE_MAX_BYTES = int(os.getenv('RECIPE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+
+WORKERS = os.cpu_count() if os.getenv('WORKERS', '1') == 'auto' else int(os.getenv('WORKERS', 1))
+WORKER_BASE_PORT = int(os.getenv('WORKER_BASE_PORT', 8100))
+
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 32))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+MAX_BUSY_REPLIES = 50
+RECENT_UPDATES_SIZE = 10000
+
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 4))
+
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', 25))
+PENDING_DIR = os.getenv('PENDING_DIR', '.')
+PENDING_POLL_INTERVAL = float(os.getenv('PENDING_POLL_INTERVAL', 2))
+PENDING_MAX_AGE = float(os.getenv('PENDING_MAX_AGE', 600))
+
+WARMER_INTERVAL = float(os.getenv('WARMER_INTERVAL', 300))
+WARMER_TOP_COMBOS = int(os.getenv('WARMER_TOP_COMBOS', 50))
+WARMER_VARIANTS = int(os.getenv('WARMER_VARIANTS', 3))
+WARMER_CONCURRENCY = int(os.getenv('WARMER_CONCURRENCY', 2))
+WARMER_MAX_LIVE = int(os.getenv('WARMER_MAX_LIVE', 2))
+WARMER_TOKEN_RESERVE = float(os.getenv('WARMER_TOKEN_RESERVE', 5))
+WARMER_TRACK_COMBOS = 500
+WARMER_TRACK_SETS = 20
+WARMER_DECAY = 0.95
+
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory').lower()
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'kitchen_state.db')
+STATE_TTL = float(os.getenv('STATE_TTL', 24 * 3600))
+STATE_MAX_CHATS = int(os.getenv('STATE_MAX_CHATS', 100000))
+
+RECIPE_DB_PATH = os.getenv('RECIPE_DB_PATH', 'kitchen_recipes.db')
+RECIPE_STORE_MAX = int(os.getenv('RECIPE_STORE_MAX', 50000))
+RECIPE_LOOKUP_LIMIT = 200
 
 DIET_RULES = {
     "🚫 Нет ограничений": {
@@ -96,102 +254,765 @@ DIET_RULES = {
             "молоко": "растительное молоко",
             "яйца": "льняная смесь (1 ст.л. льна + 3 ст.л. воды = 1 яйцо)",
             "сливочное масло": "растительное масло"
+        },
+        "variants": {
+            "яйца": ["яйцо", "яиц"]
         }
     }
 }
 
-def main_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="🍳 Создать рецепт")],
-            [KeyboardButton(text="📜 Публичная оферта")],
-            [KeyboardButton(text="📢 Наш кулинарный канал")]
-        ],
-        resize_keyboard=True
-    )
+MEAL_TIMES = ("🌅 Завтрак", "🌇 Обед", "🌃 Ужин", "☕ Перекус")
+CUISINES = (
+    "🇷🇺 Русская", "🇮🇹 Итальянская", "🇯🇵 Японская",
+    "🇬🇪 Кавказская", "🇺🇸 Американская", "🇫🇷 Французская",
+    "🇹🇷 Турецкая", "🇨🇳 Китайская", "🇲🇽 Мексиканская",
+    "🇮🇳 Индийская"
+)
+DIETS = tuple(DIET_RULES)
 
-def meal_time_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="🌅 Завтрак"), KeyboardButton(text="🌇 Обед")],
-            [KeyboardButton(text="🌃 Ужин"), KeyboardButton(text="☕ Перекус")]
-        ],
-        resize_keyboard=True
-    )
+MEAL_TIME_CHOICES = frozenset(MEAL_TIMES)
+CUISINE_CHOICES = frozenset(CUISINES)
+DIET_CHOICES = frozenset(DIETS)
 
-def cuisine_keyboard():
+def _rows(items: tuple, width: int) -> tuple:
+    return tuple(items[i:i+width] for i in range(0, len(items), width))
+
+def _reply_keyboard(rows: tuple) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="🇷🇺 Русская"), KeyboardButton(text="🇮🇹 Итальянская"), KeyboardButton(text="🇯🇵 Японская")],
-            [KeyboardButton(text="🇬🇪 Кавказская"), KeyboardButton(text="🇺🇸 Американская"), KeyboardButton(text="🇫🇷 Французская")],
-            [KeyboardButton(text="🇹🇷 Турецкая"), KeyboardButton(text="🇨🇳 Китайская"), KeyboardButton(text="🇲🇽 Мексиканская")],
-            [KeyboardButton(text="🇮🇳 Индийская")]
-        ],
+        keyboard=[[KeyboardButton(text=text) for text in row] for row in rows],
         resize_keyboard=True
     )
 
-def diet_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="🚫 Нет ограничений"), KeyboardButton(text="⚠️ Аллергии")],
-            [KeyboardButton(text="⚖️ Низкокалорийные"), KeyboardButton(text="💪 Высокобелковые")],
-            [KeyboardButton(text="☪️ Халяль"), KeyboardButton(text="☦️ Постная")]
-        ],
-        resize_keyboard=True
+# Клавиатуры собираются один раз из кортежей и дальше только отправляются, их никто не меняет
+MAIN_KEYBOARD = _reply_keyboard((("🍳 Создать рецепт",), ("📜 Публичная оферта",), ("📢 Наш кулинарный канал",)))
+MEAL_TIME_KEYBOARD = _reply_keyboard(_rows(MEAL_TIMES, 2))
+CUISINE_KEYBOARD = _reply_keyboard(_rows(CUISINES, 3))
+DIET_KEYBOARD = _reply_keyboard(_rows(DIETS, 2))
+
+def create_yandex_client():
+    # Один долгоживущий клиент на процесс: keep-alive и HTTP/2 избавляют от TLS-рукопожатия на каждый рецепт
+    http2 = YANDEX_HTTP2 and importlib.util.find_spec("h2") is not None
+    if YANDEX_HTTP2 and not http2:
+        logger.warning("Пакет h2 не установлен, YandexGPT работает по HTTP/1.1")
+    return httpx.AsyncClient(
+        http2=http2,
+        timeout=httpx.Timeout(
+            YANDEX_READ_TIMEOUT,
+            connect=YANDEX_CONNECT_TIMEOUT,
+            pool=YANDEX_POOL_TIMEOUT
+        ),
+        limits=httpx.Limits(
+            max_connections=YANDEX_MAX_CONNECTIONS,
+            max_keepalive_connections=YANDEX_MAX_KEEPALIVE,
+            keepalive_expiry=YANDEX_KEEPALIVE_EXPIRY
+        ),
+        headers={"Authorization": f"Api-Key {YANDEX_API_KEY}"}
     )
 
+def get_yandex_client():
+    global yandex_client
+    if yandex_client is None or yandex_client.is_closed:
+        yandex_client = create_yandex_client()
+    return yandex_client
+
+async def close_yandex_client():
+    global yandex_client
+    if yandex_client is not None:
+        await yandex_client.aclose()
+        yandex_client = None
+
 def ensure_russian(text):
     return re.sub(r'[a-zA-Z]', '', text).strip()
 
-async def safe_api_call(call, *args, **kwargs):
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        return self.values.get(label_values, 0)
+
+    def render(self) -> list:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value: float):
+        self.values[label_values] = value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, *label_values, value: float):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*label_values, value=time.perf_counter() - started)
+
+    def render(self) -> list:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labels, key, 'le="{}"'.format(bound))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            inf_labels = _format_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf_labels} {count}")
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Метрики процесса в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.register(Histogram(
+    "kitchen_stage_seconds", "Длительность этапов обработки", ("stage",)
+))
+GENERATIONS_IN_FLIGHT = metrics.register(Gauge(
+    "kitchen_generations_in_flight", "Рецепты, генерируемые прямо сейчас"
+))
+API_RETRIES = metrics.register(Counter(
+    "kitchen_api_retries_total", "Повторные запросы к API по номеру попытки", ("api", "attempt")
+))
+ERRORS = metrics.register(Counter(
+    "kitchen_errors_total", "Ошибки по этапу и классу исключения", ("stage", "error")
+))
+YANDEX_TOKENS = metrics.register(Counter(
+    "kitchen_yandex_tokens_total", "Токены YandexGPT из блока usage", ("kind",)
+))
+MODEL_REQUESTS = metrics.register(Counter(
+    "kitchen_model_requests_total", "Запросы к моделям YandexGPT по исходу", ("model", "outcome")
+))
+HEDGES = metrics.register(Counter(
+    "kitchen_hedged_requests_total", "Хеджированные запросы по победителю", ("winner",)
+))
+RECIPE_CACHE_EVENTS = metrics.register(Gauge(
+    "kitchen_recipe_cache", "Счётчики и размер кэша рецептов", ("stat",)
+))
+RECIPE_POOL_STATS = metrics.register(Gauge(
+    "kitchen_recipe_pool", "Заранее сгенерированные рецепты", ("stat",)
+))
+RECIPE_STORE_STATS = metrics.register(Gauge(
+    "kitchen_recipe_store", "Хранилище разобранных рецептов", ("stat",)
+))
+UPDATE_QUEUE_STATS = metrics.register(Gauge(
+    "kitchen_update_queue", "Состояние очереди апдейтов", ("stat",)
+))
+
+async def handle_metrics(request):
+    return web.Response(body=metrics.render().encode('utf-8'), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+class TokenBucket:
+    """Токен-бакет с резервированием: ожидающие выстраиваются в очередь, а не просыпаются одновременно"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        self._refill()
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def pause(self, seconds: float):
+        # Подсказка сервера (Retry-After): следующий токен появится не раньше чем через seconds
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+yandex_limiter = TokenBucket(YANDEX_RPS, YANDEX_BURST)
+limit_share = 1
+
+def share_limits(workers: int):
+    # Квоты YandexGPT и Telegram общие на бота, поэтому каждый из воркеров получает свою долю
+    global yandex_limiter, limit_share
+    limit_share = workers
+    yandex_limiter = TokenBucket(YANDEX_RPS / workers, max(1.0, YANDEX_BURST / workers))
+
+def retry_delay(attempt: int, retry_after: float = None) -> float:
+    # Экспоненциальная задержка с полным джиттером, чтобы повторы не шли синхронно
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, REQUEST_DELAY * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+def parse_retry_after(response: httpx.Response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+async def safe_api_call(call, *args, limiter: TokenBucket = None, api: str = "yandex", **kwargs):
     for attempt in range(MAX_RETRIES):
+        if limiter is not None:
+            await limiter.acquire()
+        if attempt:
+            API_RETRIES.inc(api, str(attempt + 1))
+        retry_after = None
         try:
-            return await call(*args, **kwargs)
-        except (httpx.ReadTimeout, httpx.ConnectTimeout):
+            result = await call(*args, **kwargs)
+            if not isinstance(result, httpx.Response) or result.status_code not in RETRYABLE_STATUSES:
+                return result
+            result.raise_for_status()
+        except RETRYABLE_ERRORS as e:
             if attempt == MAX_RETRIES - 1:
+                ERRORS.inc(api, type(e).__name__)
+                raise
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in RETRYABLE_STATUSES or attempt == MAX_RETRIES - 1:
+                ERRORS.inc(api, f"HTTP {e.response.status_code}")
+                logger.error("API call error: %s", e, extra={"stage": api})
                 raise
-            await asyncio.sleep(REQUEST_DELAY * (attempt + 1))
+            retry_after = parse_retry_after(e.response)
+            if retry_after is not None and limiter is not None:
+                limiter.pause(retry_after)
         except Exception as e:
-            logger.error(f"API call error: {str(e)}")
+            ERRORS.inc(api, type(e).__name__)
+            logger.error("API call error: %s", e, extra={"stage": api})
             raise
+        await asyncio.sleep(retry_delay(attempt, retry_after))
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    """Общий и по-чатовый лимит исходящих сообщений, повтор при flood control и 5xx"""
+
+    def __init__(self, global_rps: float, chat_rps: float, chat_burst: float, max_chats: int = 10000):
+        self.global_bucket = TokenBucket(global_rps, global_rps)
+        self.chat_rps = chat_rps
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self._chat_buckets = OrderedDict()
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rps, self.chat_burst)
+            if len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        paced = chat_id is not None and not isinstance(method, SendChatAction)
+        for attempt in range(MAX_RETRIES):
+            if paced:
+                await self.chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire()
+            if attempt:
+                API_RETRIES.inc("telegram", str(attempt + 1))
+            try:
+                with STAGE_SECONDS.time("telegram_send"):
+                    return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == MAX_RETRIES - 1:
+                    ERRORS.inc("telegram", type(e).__name__)
+                    raise
+                (self.chat_bucket(chat_id) if paced else self.global_bucket).pause(e.retry_after)
+                await asyncio.sleep(retry_delay(attempt, e.retry_after))
+            except TelegramServerError as e:
+                if attempt == MAX_RETRIES - 1:
+                    ERRORS.inc("telegram", type(e).__name__)
+                    raise
+                await asyncio.sleep(retry_delay(attempt))
+
+def create_bot() -> Bot:
+    if TELEGRAM_API_URL:
+        # Локальный Bot API сервер или заглушка для нагрузочных тестов
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    else:
+        session = AiohttpSession()
+    # Чат всегда обслуживает один воркер, поэтому делится только общий лимит
+    session.middleware(TelegramRateLimiter(TELEGRAM_GLOBAL_RPS / limit_share, TELEGRAM_CHAT_RPS, TELEGRAM_CHAT_BURST))
+    return Bot(token=os.getenv('TELEGRAM_BOT_TOKEN'), session=session)
+
+class TermMatcher:
+    """Автомат Ахо-Корасик: находит все термины словаря в строке за один проход"""
+
+    __slots__ = ("_goto", "_fail", "_out")
+
+    def __init__(self, terms: dict):
+        # terms: словоформа -> термин, под которым её нужно вернуть
+        self._goto = [{}]
+        self._out = [frozenset()]
+        for pattern, label in terms.items():
+            node = 0
+            for ch in pattern:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._out.append(frozenset())
+                node = nxt
+            self._out[node] = self._out[node] | {label}
+
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._out[child] = self._out[child] | self._out[self._fail[child]]
+
+    def __bool__(self):
+        return len(self._goto) > 1
+
+    def find(self, text: str) -> set:
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found |= out[node]
+        return found
+
+class DietMatcher:
+    __slots__ = ("source", "forbidden", "replacements", "_terms")
+
+    def __init__(self, forbidden, replacements: dict, variants: dict = None, source: str = ""):
+        self.source = source
+        self.forbidden = frozenset(item.strip().lower() for item in forbidden if item.strip())
+        self.replacements = replacements
+        terms = {term: term for term in self.forbidden}
+        terms.update((original, original) for original in replacements)
+        for term, forms in (variants or {}).items():
+            terms.update((form, term) for form in forms)
+        self._terms = TermMatcher(terms)
 
-def check_diet_conflicts(ingredients: str, diet_type: str, allergies: str = "") -> tuple:
-    if diet_type not in DIET_RULES:
+    def check(self, ingredients_list: list) -> tuple:
+        conflicts = []
+        replacement_lines = []
+        if not self.forbidden:
+            return conflicts, replacement_lines
+        for ingredient in ingredients_list:
+            found = self._terms.find(ingredient)
+            if found.isdisjoint(self.forbidden):
+                continue
+            conflicts.append(ingredient)
+            for original, replacement in self.replacements.items():
+                if original in found:
+                    replacement_lines.append(f"- {ingredient} → {replacement}\n")
+        return conflicts, replacement_lines
+
+DIET_MATCHERS = MappingProxyType({
+    diet_type: DietMatcher(rules["forbidden"], rules["replacements"], rules.get("variants"))
+    for diet_type, rules in DIET_RULES.items()
+})
+
+def compile_allergies(allergies: str) -> DietMatcher:
+    return DietMatcher(allergies.split(','), {}, source=allergies)
+
+def check_diet_conflicts(ingredients: str, diet_type: str, allergies: str = "", matcher: DietMatcher = None) -> tuple:
+    if diet_type not in DIET_MATCHERS:
         return [], ""
-    
-    ingredients_list = [i.strip().lower() for i in ingredients.split(',')]
-    forbidden = DIET_RULES[diet_type]["forbidden"]
-    
+
     if diet_type == "⚠️ Аллергии":
-        forbidden = [a.strip().lower() for a in allergies.split(',') if a.strip()]
-    
-    conflicts = []
-    for ingredient in ingredients_list:
-        for forbidden_item in forbidden:
-            if forbidden_item and forbidden_item in ingredient:
-                conflicts.append(ingredient)
-                break
-    
+        matcher = matcher or compile_allergies(allergies)
+    else:
+        matcher = DIET_MATCHERS[diet_type]
+
+    ingredients_list = [i.strip().lower() for i in ingredients.split(',')]
+    conflicts, replacement_lines = matcher.check(ingredients_list)
+
     replacement_note = ""
-    if conflicts and diet_type in DIET_RULES and DIET_RULES[diet_type]["replacements"]:
-        replacement_note = "\nВозможные замены:\n"
-        for conflict in conflicts:
-            for original, replacement in DIET_RULES[diet_type]["replacements"].items():
-                if original in conflict:
-                    replacement_note += f"- {conflict} → {replacement}\n"
-    
+    if conflicts and matcher.replacements:
+        replacement_note = "\nВозможные замены:\n" + "".join(replacement_lines)
+
     return conflicts, replacement_note
 
-@dp.message(Command("start", "help"))
+def _normalize_list(text: str) -> tuple:
+    items = (" ".join(item.lower().split()) for item in text.split(','))
+    return tuple(sorted(set(item for item in items if item)))
+
+def recipe_cache_key(data: dict) -> tuple:
+    allergies = data.get('allergies', "") if data['diet_type'] == "⚠️ Аллергии" else ""
+    return (
+        data['meal_time'],
+        data['cuisine'],
+        data['diet_type'],
+        _normalize_list(allergies),
+        _normalize_list(data['ingredients'])
+    )
+
+class RecipeCache:
+    """LRU-кэш готовых рецептов с TTL, ограничением по памяти и объединением одинаковых запросов"""
+
+    def __init__(self, max_entries: int, ttl: float, max_bytes: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.abandoned = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._waiters = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, _, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value: str):
+        if self.max_entries <= 0:
+            return
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, value)
+        self.size_bytes += size
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.size_bytes -= size
+
+    async def get_or_fetch(self, key, fetch):
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_fetched(key, t))
+        else:
+            self.coalesced += 1
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # shield: отмена одного ожидающего не должна обрывать общий запрос для остальных
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                # Ждать результат больше некому — отменяем запрос к YandexGPT, чтобы не тратить квоту
+                if not task.done():
+                    task.cancel()
+                    self._inflight.pop(key, None)
+                    self.abandoned += 1
+
+    def _on_fetched(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, task.result())
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size_bytes,
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+recipe_cache = RecipeCache(RECIPE_CACHE_SIZE, RECIPE_CACHE_TTL, RECIPE_CACHE_MAX_BYTES)
+
+@dataclass(slots=True)
+class ChatState:
+    step: str = ""
+    meal_time: str = ""
+    cuisine: str = ""
+    diet_type: str = ""
+    allergies: str = ""
+    ingredients: str = ""
+    # Скомпилированный список аллергенов живёт вместе с состоянием и не сохраняется в хранилище
+    allergy_matcher: DietMatcher = field(default=None, repr=False, compare=False)
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in CHAT_STATE_FIELDS}
+
+    def get_allergy_matcher(self) -> DietMatcher:
+        if self.allergy_matcher is None or self.allergy_matcher.source != self.allergies:
+            self.allergy_matcher = compile_allergies(self.allergies)
+        return self.allergy_matcher
+
+CHAT_STATE_FIELDS = tuple(f.name for f in fields(ChatState) if f.name != "allergy_matcher")
+
+class StateStore(ABC):
+    """Хранилище состояний диалога: запись живёт STATE_TTL секунд с последнего изменения"""
+
+    @abstractmethod
+    async def get(self, chat_id: int):
+        ...
+
+    @abstractmethod
+    async def set(self, chat_id: int, state: ChatState):
+        ...
+
+    @abstractmethod
+    async def delete(self, chat_id: int):
+        ...
+
+    def close(self):
+        pass
+
+class MemoryStateStore(StateStore):
+    def __init__(self, max_chats: int, ttl: float):
+        self.max_chats = max_chats
+        self.ttl = ttl
+        self.evictions = 0
+        # Порядок ключей совпадает с порядком последних записей, поэтому протухшие записи всегда в начале
+        self._states = OrderedDict()
+
+    def __len__(self):
+        return len(self._states)
+
+    async def get(self, chat_id: int):
+        entry = self._states.get(chat_id)
+        if entry is None:
+            return None
+        updated_at, state = entry
+        if updated_at + self.ttl < time.monotonic():
+            del self._states[chat_id]
+            return None
+        return state
+
+    async def set(self, chat_id: int, state: ChatState):
+        now = time.monotonic()
+        self._states[chat_id] = (now, state)
+        self._states.move_to_end(chat_id)
+        while self._states:
+            oldest_id, (updated_at, _) = next(iter(self._states.items()))
+            if updated_at + self.ttl >= now and len(self._states) <= self.max_chats:
+                break
+            del self._states[oldest_id]
+            self.evictions += 1
+
+    async def delete(self, chat_id: int):
+        self._states.pop(chat_id, None)
+
+class SQLiteStateStore(StateStore):
+    PURGE_EVERY = 256
+
+    def __init__(self, path: str, max_chats: int, ttl: float):
+        self.max_chats = max_chats
+        self.ttl = ttl
+        self._writes = 0
+        self._lock = threading.Lock()
+        # WAL позволяет нескольким процессам бота читать и писать одну базу
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chat_states ("
+            "chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS chat_states_updated_at ON chat_states (updated_at)")
+
+    # Запросы идут в потоке: ожидание блокировки базы другим процессом не останавливает цикл событий
+    async def get(self, chat_id: int):
+        return await asyncio.to_thread(self._get, chat_id)
+
+    async def set(self, chat_id: int, state: ChatState):
+        await asyncio.to_thread(self._set, chat_id, state.to_dict())
+
+    async def delete(self, chat_id: int):
+        await asyncio.to_thread(self._delete, chat_id)
+
+    def _get(self, chat_id: int):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM chat_states WHERE chat_id = ? AND updated_at >= ?",
+                (chat_id, time.time() - self.ttl)
+            ).fetchone()
+        if row is None:
+            return None
+        return ChatState(**json.loads(row[0]))
+
+    def _set(self, chat_id: int, data: dict):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO chat_states (chat_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (chat_id, json.dumps(data, ensure_ascii=False), time.time())
+            )
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                self._purge()
+
+    def _delete(self, chat_id: int):
+        with self._lock:
+            self._db.execute("DELETE FROM chat_states WHERE chat_id = ?", (chat_id,))
+
+    def _purge(self):
+        self._db.execute("DELETE FROM chat_states WHERE updated_at < ?", (time.time() - self.ttl,))
+        self._db.execute(
+            "DELETE FROM chat_states WHERE chat_id IN ("
+            "SELECT chat_id FROM chat_states ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_chats,)
+        )
+
+    def close(self):
+        self._db.close()
+
+def create_state_store() -> StateStore:
+    if STATE_BACKEND == 'sqlite':
+        return SQLiteStateStore(STATE_DB_PATH, STATE_MAX_CHATS, STATE_TTL)
+    if STATE_BACKEND != 'memory':
+        logger.warning("Неизвестный STATE_BACKEND=%s, используется memory", STATE_BACKEND)
+    return MemoryStateStore(STATE_MAX_CHATS, STATE_TTL)
+
+state_store = None
+
+@router.message(Command("start", "help"))
 async def cmd_start(message: types.Message):
     await message.answer(
         "👨‍🍳 Привет! Я - кулинарный бот с генерацией рецептов. Мой профиль: {}\n"
         "⚠️ Рецепты создаются искусственным интеллектом и могут содержать неточности.\n\n"
         "Нажмите кнопку ниже, чтобы создать рецепт ↓".format(os.getenv('BOT_LINK')),
-        reply_markup=main_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
 
-@dp.message(F.text == "📜 Публичная оферта")
+@router.message(Command("cook"))
+async def cmd_cook(message: types.Message, command: CommandObject):
+    if recipe_store is None:
+        await message.answer("Поиск по сохранённым рецептам выключен", reply_markup=MAIN_KEYBOARD)
+        return
+    if not command.args:
+        await message.answer(
+            "🧺 Напишите, что есть дома, например:\n/cook курица, картофель, лук",
+            reply_markup=MAIN_KEYBOARD
+        )
+        return
+
+    available = frozenset().union(*map(ingredient_terms, command.args.split(',')))
+    matches = await asyncio.to_thread(recipe_store.search, available)
+    if not matches:
+        await message.answer(
+            "😔 Среди сохранённых рецептов ничего не нашлось. Нажмите «🍳 Создать рецепт», и я придумаю новый",
+            reply_markup=MAIN_KEYBOARD
+        )
+        return
+
+    record, cuisine, diet_type, missing = matches[0]
+    text = format_recipe(record, cuisine, diet_type)
+    if missing:
+        text += "\n\n🛒 Не хватает: " + ", ".join(missing)
+    if len(matches) > 1:
+        text += "\n\nЕщё можно приготовить:\n" + "\n".join(
+            f"- {other['title']}" + (f" (не хватает: {', '.join(other_missing)})" if other_missing else "")
+            for other, _, _, other_missing in matches[1:]
+        )
+    for part in split_message(text):
+        await message.answer(part, reply_markup=MAIN_KEYBOARD)
+
+@router.message(F.text == "📜 Публичная оферта")
 async def show_offer(message: types.Message):
     await message.answer(
         "📄 Публичная оферта:\n\n"
@@ -201,67 +1022,72 @@ async def show_offer(message: types.Message):
         disable_web_page_preview=True
     )
 
-@dp.message(F.text == "📢 Наш кулинарный канал")
+@router.message(F.text == "📢 Наш кулинарный канал")
 async def show_channel(message: types.Message):
     markup = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🍳 AI Kitchen Channel", url=CHANNEL_LINK)]
     ])
     await message.answer("🔔 Подпишитесь на наш кулинарный канал с рецептами и кулинарными лайфхаками!", reply_markup=markup)
 
-@dp.message(F.text == "🍳 Создать рецепт")
+@router.message(F.text == "🍳 Создать рецепт")
 async def ask_meal_time(message: types.Message):
-    user_states[message.chat.id] = {"step": "waiting_meal_time"}
-    await message.answer("🕒 Для какого приёма пищи нужен рецепт?", reply_markup=meal_time_keyboard())
+    await state_store.set(message.chat.id, ChatState(step="waiting_meal_time"))
+    await message.answer("🕒 Для какого приёма пищи нужен рецепт?", reply_markup=MEAL_TIME_KEYBOARD)
 
-@dp.message(lambda msg: user_states.get(msg.chat.id, {}).get("step") == "waiting_meal_time")
-async def ask_cuisine(message: types.Message):
-    if message.text not in ["🌅 Завтрак", "🌇 Обед", "🌃 Ужин", "☕ Перекус"]:
-        await message.answer("Пожалуйста, выберите вариант из кнопок ↓", reply_markup=meal_time_keyboard())
+async def ask_cuisine(message: types.Message, state: ChatState):
+    if message.text not in MEAL_TIME_CHOICES:
+        await message.answer("Пожалуйста, выберите вариант из кнопок ↓", reply_markup=MEAL_TIME_KEYBOARD)
         return
-    user_states[message.chat.id] = {"step": "waiting_cuisine", "meal_time": message.text}
-    await message.answer("🌍 Выберите кухню:", reply_markup=cuisine_keyboard())
+    await state_store.set(message.chat.id, ChatState(step="waiting_cuisine", meal_time=message.text))
+    await message.answer("🌍 Выберите кухню:", reply_markup=CUISINE_KEYBOARD)
 
-@dp.message(lambda msg: user_states.get(msg.chat.id, {}).get("step") == "waiting_cuisine")
-async def ask_diet(message: types.Message):
-    if message.text not in [btn.text for row in cuisine_keyboard().keyboard for btn in row]:
-        await message.answer("Пожалуйста, выберите вариант из кнопок ↓", reply_markup=cuisine_keyboard())
+async def ask_diet(message: types.Message, state: ChatState):
+    if message.text not in CUISINE_CHOICES:
+        await message.answer("Пожалуйста, выберите вариант из кнопок ↓", reply_markup=CUISINE_KEYBOARD)
         return
-    user_states[message.chat.id]["cuisine"] = message.text
-    user_states[message.chat.id]["step"] = "waiting_diet"
-    await message.answer("🥗 Есть ли диетические ограничения?", reply_markup=diet_keyboard())
+    state.cuisine = message.text
+    state.step = "waiting_diet"
+    await state_store.set(message.chat.id, state)
+    await message.answer("🥗 Есть ли диетические ограничения?", reply_markup=DIET_KEYBOARD)
 
-@dp.message(lambda msg: user_states.get(msg.chat.id, {}).get("step") == "waiting_diet")
-async def process_diet_choice(message: types.Message):
-    user_states[message.chat.id]["diet_type"] = message.text
+async def process_diet_choice(message: types.Message, state: ChatState):
+    if message.text not in DIET_CHOICES:
+        await message.answer("Пожалуйста, выберите вариант из кнопок ↓", reply_markup=DIET_KEYBOARD)
+        return
+    state.diet_type = message.text
     if message.text == "⚠️ Аллергии":
-        user_states[message.chat.id]["step"] = "waiting_allergies"
+        state.step = "waiting_allergies"
+        await state_store.set(message.chat.id, state)
         await message.answer("📝 Укажите продукты, которые нужно исключить (через запятую):", reply_markup=types.ReplyKeyboardRemove())
     else:
-        user_states[message.chat.id]["step"] = "waiting_ingredients"
+        state.step = "waiting_ingredients"
+        await state_store.set(message.chat.id, state)
         await ask_for_ingredients(message.chat.id)
 
-@dp.message(lambda msg: user_states.get(msg.chat.id, {}).get("step") == "waiting_allergies")
-async def process_allergies(message: types.Message):
-    user_states[message.chat.id]["allergies"] = message.text
-    user_states[message.chat.id]["step"] = "waiting_ingredients"
+async def process_allergies(message: types.Message, state: ChatState):
+    state.allergies = message.text
+    state.step = "waiting_ingredients"
+    await state_store.set(message.chat.id, state)
     await ask_for_ingredients(message.chat.id)
 
 async def ask_for_ingredients(chat_id: int):
     await bot.send_message(chat_id, "📝 Введите ингредиенты через запятую:\nПример: 2 яйца, 100г муки, 1 ст.л. масла", reply_markup=types.ReplyKeyboardRemove())
 
-@dp.message(lambda msg: user_states.get(msg.chat.id, {}).get("step") == "waiting_ingredients")
-async def process_ingredients(message: types.Message):
-    user_states[message.chat.id]["ingredients"] = message.text
+async def process_ingredients(message: types.Message, state: ChatState):
+    state.ingredients = message.text
+    await state_store.set(message.chat.id, state)
     await message.answer("🔄 Проверяю ингредиенты...")
     
-    diet_type = user_states[message.chat.id]["diet_type"]
-    allergies = user_states[message.chat.id].get("allergies", "")
+    diet_type = state.diet_type
+    allergies = state.allergies
     
-    conflicts, replacements = check_diet_conflicts(
-        message.text, 
-        diet_type,
-        allergies
-    )
+    with STAGE_SECONDS.time("diet_check"):
+        conflicts, replacements = check_diet_conflicts(
+            message.text, 
+            diet_type,
+            allergies,
+            state.get_allergy_matcher() if diet_type == "⚠️ Аллергии" else None
+        )
     
     if conflicts:
         warning_msg = f"⚠️ Внимание: эти ингредиенты не соответствуют выбранной диете ({diet_type}):\n"
@@ -273,160 +1099,1395 @@ async def process_ingredients(message: types.Message):
     await message.answer("🔄 Генерирую рецепт с учетом диетических ограничений...")
     await generate_recipe(message.chat.id)
 
-async def generate_recipe(chat_id: int):
+STEP_HANDLERS = MappingProxyType({
+    "waiting_meal_time": ask_cuisine,
+    "waiting_cuisine": ask_diet,
+    "waiting_diet": process_diet_choice,
+    "waiting_allergies": process_allergies,
+    "waiting_ingredients": process_ingredients
+})
+
+class WizardStep(BaseFilter):
+    """Одно чтение состояния и один поиск в таблице шагов на сообщение, независимо от числа шагов"""
+
+    async def __call__(self, message: types.Message):
+        if message.text is None:
+            return False
+        state = await state_store.get(message.chat.id)
+        if state is None:
+            return False
+        handler = STEP_HANDLERS.get(state.step)
+        if handler is None:
+            return False
+        return {"chat_state": state, "step_handler": handler}
+
+@router.message(WizardStep())
+async def dispatch_step(message: types.Message, chat_state: ChatState, step_handler):
+    await step_handler(message, chat_state)
+
+def build_recipe_prompt(data: dict) -> str:
+    diet_info = DIET_RULES.get(data['diet_type'], DIET_RULES["🚫 Нет ограничений"])
+    diet_description = diet_info["description"]
+
+    if data['diet_type'] == "⚠️ Аллергии":
+        diet_description = diet_description.format(allergies=data.get('allergies', ''))
+
+    prompt_lines = [
+        "Ты профессиональный шеф-повар. Сгенерируй рецепт по следующим параметрам:",
+        "",
+        f"Тип блюда: {data['meal_time']}",
+        f"Кухня: {data['cuisine']}",
+        f"Диета: {data['diet_type']} ({diet_description})",
+        f"Исходные ингредиенты: {data['ingredients']}",
+        "",
+        "Требования:",
+        "- Строго соблюдай диетические ограничения",
+        "- Если ингредиенты не подходят - замени их",
+        "- Никогда не предлагай поискать в интернете",
+        "",
+        "Формат ответа (обязателен):",
+        "🍽 Название блюда",
+        f"🌍 Кухня: {data['cuisine']}",
+        f"🥗 Диета: {data['diet_type']}",
+        "⏱ Время приготовления: [время]",
+        "👨‍🍳 Порций: [число]",
+        "",
+        "📋 Ингредиенты (на 1 порцию):",
+        "- [название] [количество]",
+        "",
+        "🔪 Приготовление:",
+        "1. [шаг 1]",
+        "2. [шаг 2]",
+        "",
+        "📊 КБЖУ на порцию:",
+        "- Калории: [значение]",
+        "- Белки: [значение]",
+        "- Жиры: [значение]",
+        "- Углеводы: [значение]",
+        "",
+        "💡 Советы:",
+        "- [полезный совет]"
+    ]
+
+    return "\n".join(prompt_lines)
+
+def postprocess_recipe(text: str) -> str:
+    recipe = ensure_russian(text)
+
+    if "интернет" in recipe.lower() or "поиск" in recipe.lower():
+        recipe = "🍽 Рецепт (адаптированный под ваши параметры)\n\n" + recipe
+        recipe = recipe.replace("Вы можете найти рецепты в интернете", "")
+        recipe = recipe.replace("Посмотрите в поиске", "")
+
+    return recipe
+
+async def _stream_completion(headers: dict, body: dict, on_partial) -> dict:
+    result = None
+    async with get_yandex_client().stream("POST", YANDEX_GPT_URL, headers=headers, content=json.dumps(body)) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.strip():
+                continue
+            # В потоковом режиме YandexGPT присылает в каждом чанке весь накопленный текст
+            result = json.loads(line)['result']
+            await on_partial(result['alternatives'][0]['message']['text'])
+    return result
+
+def record_usage(result: dict):
+    usage = result.get('usage') or {}
+    for kind, key in (("input", "inputTextTokens"), ("completion", "completionTokens")):
+        if key in usage:
+            YANDEX_TOKENS.inc(kind, amount=int(usage[key]))
+
+class ModelStats:
+    __slots__ = ("samples", "max_age")
+
+    def __init__(self, window: int, max_age: float):
+        self.samples = deque(maxlen=window)
+        self.max_age = max_age
+
+    def record(self, latency: float, ok: bool):
+        self.samples.append((time.monotonic(), latency, ok))
+
+    def _expire(self):
+        # Старые замеры устаревают, поэтому модель, давно признанная нездоровой, снова получает шанс
+        deadline = time.monotonic() - self.max_age
+        while self.samples and self.samples[0][0] < deadline:
+            self.samples.popleft()
+
+    def p95(self):
+        self._expire()
+        latencies = sorted(latency for _, latency, ok in self.samples if ok)
+        if len(latencies) < MODEL_MIN_SAMPLES:
+            return None
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def error_rate(self) -> float:
+        self._expire()
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, _, ok in self.samples if not ok) / len(self.samples)
+
+class ModelRouter:
+    """Выбор модели по наблюдаемой задержке и доле ошибок, хеджирование медленных запросов с ограничением доли"""
+
+    def __init__(self, primary: str, fallback: str, latency_budget: float, error_budget: float,
+                 hedge_rate: float, hedge_min_delay: float, window: int, sample_ttl: float, probe_rate: float):
+        self.primary = primary
+        self.fallback = fallback
+        self.latency_budget = latency_budget
+        self.error_budget = error_budget
+        self.hedge_rate = hedge_rate
+        self.hedge_min_delay = hedge_min_delay
+        self.probe_rate = probe_rate
+        self.stats = {model: ModelStats(window, sample_ttl) for model in (primary, fallback)}
+        self._hedged = deque(maxlen=window)
+
+    def record(self, model: str, latency: float, ok: bool):
+        self.stats[model].record(latency, ok)
+        MODEL_REQUESTS.inc(model, "ok" if ok else "error")
+
+    def record_cancelled(self, model: str, latency: float):
+        # Проигравший хедж медленный по определению: без него p95 не видит именно долгие запросы
+        self.stats[model].record(latency, ok=True)
+        MODEL_REQUESTS.inc(model, "cancelled")
+
+    def healthy(self, model: str) -> bool:
+        stats = self.stats[model]
+        p95 = stats.p95()
+        return (p95 is None or p95 <= self.latency_budget) and stats.error_rate() <= self.error_budget
+
+    def pick(self) -> str:
+        if self.healthy(self.primary) or not self.healthy(self.fallback):
+            return self.primary
+        # Небольшая доля пробных запросов к основной модели, чтобы заметить её восстановление
+        if random.random() < self.probe_rate:
+            return self.primary
+        return self.fallback
+
+    def hedge_delay(self, model: str):
+        p95 = self.stats[model].p95()
+        if p95 is None or self.hedge_rate <= 0:
+            return None
+        return max(self.hedge_min_delay, p95)
+
+    def hedge_model(self, model: str) -> str:
+        other = self.fallback if model == self.primary else self.primary
+        return other if self.healthy(other) else model
+
+    def allow_hedge(self) -> bool:
+        # Доля хеджированных запросов в окне не превышает hedge_rate, поэтому расход токенов ограничен
+        return sum(self._hedged) + 1 <= self.hedge_rate * max(len(self._hedged), 1)
+
+    def note_request(self, hedged: bool):
+        self._hedged.append(1 if hedged else 0)
+
+model_router = ModelRouter(
+    YANDEX_MODEL,
+    YANDEX_FALLBACK_MODEL,
+    MODEL_LATENCY_BUDGET,
+    MODEL_ERROR_BUDGET,
+    HEDGE_MAX_RATE,
+    HEDGE_MIN_DELAY,
+    MODEL_WINDOW,
+    MODEL_SAMPLE_TTL,
+    MODEL_PROBE_RATE
+)
+
+async def complete_with_model(model: str, body: dict, on_partial=None) -> dict:
+    headers = {"Content-Type": "application/json"}
+    body = dict(body, modelUri=f"gpt://{YANDEX_FOLDER_ID}/{model}")
+    started = time.perf_counter()
     try:
-        data = user_states[chat_id]
-        await bot.send_chat_action(chat_id, 'typing')
+        if on_partial is not None:
+            result = await safe_api_call(_stream_completion, headers, body, on_partial, limiter=yandex_limiter)
+        else:
+            yandex_response = await safe_api_call(
+                get_yandex_client().post,
+                YANDEX_GPT_URL,
+                headers=headers,
+                data=json.dumps(body),
+                limiter=yandex_limiter
+            )
+            yandex_response.raise_for_status()
+            result = yandex_response.json()['result']
+    except Exception:
+        model_router.record(model, time.perf_counter() - started, ok=False)
+        raise
+    model_router.record(model, time.perf_counter() - started, ok=True)
+    return result
+
+async def hedged_completion(body: dict) -> dict:
+    model = model_router.pick()
+    started = time.perf_counter()
+    primary = asyncio.ensure_future(complete_with_model(model, body))
+    backup = None
+    try:
+        delay = model_router.hedge_delay(model)
+        if delay is not None:
+            await asyncio.wait({primary}, timeout=delay)
+        if delay is None or primary.done() or not model_router.allow_hedge():
+            model_router.note_request(hedged=False)
+            return await primary
+
+        model_router.note_request(hedged=True)
+        backup_model = model_router.hedge_model(model)
+        backup_started = time.perf_counter()
+        backup = asyncio.ensure_future(complete_with_model(backup_model, body))
+        pending = {primary, backup}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    HEDGES.inc("primary" if task is primary else "backup")
+                    if pending:
+                        loser_model, loser_started = (backup_model, backup_started) if task is primary else (model, started)
+                        model_router.record_cancelled(loser_model, time.perf_counter() - loser_started)
+                    return task.result()
+        return primary.result()
+    finally:
+        # Проигравший запрос отменяется вместе с HTTP-соединением
+        primary.cancel()
+        if backup is not None:
+            backup.cancel()
+
+async def request_recipe(data: dict, on_partial=None) -> str:
+    body = {
+        "completionOptions": {
+            "stream": on_partial is not None,
+            "temperature": 0.5,
+            "maxTokens": 2000
+        },
+        "messages": [
+            {
+                "role": "system",
+                "text": "Ты профессиональный шеф-повар. Всегда генерируй рецепты. Никогда не предлагай поискать в интернете. Строго соблюдай формат."
+            },
+            {
+                "role": "user",
+                "text": build_recipe_prompt(data)
+            }
+        ]
+    }
+
+    with STAGE_SECONDS.time("yandex"):
+        if on_partial is not None:
+            # Поток уже виден пользователю, поэтому его не дублируем: только выбор модели
+            result = await complete_with_model(model_router.pick(), body, on_partial)
+        else:
+            result = await hedged_completion(body)
+
+    record_usage(result)
+    with STAGE_SECONDS.time("postprocess"):
+        recipe = postprocess_recipe(result['alternatives'][0]['message']['text'])
+    remember_recipe(data, recipe)
+    return recipe
+
+def split_message(text: str) -> list:
+    if len(text) > TELEGRAM_MESSAGE_LIMIT:
+        return [text[i:i+TELEGRAM_MESSAGE_LIMIT] for i in range(0, len(text), TELEGRAM_MESSAGE_LIMIT)]
+    return [text]
+
+class RecipeStreamer:
+    """Показывает рецепт по мере генерации, редактируя сообщения не чаще раза в STREAM_EDIT_INTERVAL секунд"""
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.message_ids = []
+        self.sent_parts = []
+        self.last_flush = 0.0
+
+    async def update(self, text: str):
+        if self.message_ids and time.monotonic() - self.last_flush < STREAM_EDIT_INTERVAL:
+            return
+        text = ensure_russian(text)
+        if not text:
+            return
+        try:
+            await self._flush(split_message(text))
+        except Exception as e:
+            # Ошибка отображения не должна обрывать генерацию, финальный текст всё равно будет отправлен
+            logger.error("Ошибка обновления сообщения: %s", e, extra={"chat_id": self.chat_id, "stage": "stream"})
+
+    async def finish(self, recipe: str, markup):
+        await self._flush(split_message(recipe), markup)
+        for message_id in self.message_ids[len(self.sent_parts):]:
+            await bot.delete_message(self.chat_id, message_id)
+        del self.message_ids[len(self.sent_parts):]
+
+    async def _flush(self, parts: list, markup=None):
+        for i, part in enumerate(parts):
+            if i >= len(self.message_ids):
+                message = await bot.send_message(self.chat_id, part, reply_markup=markup)
+                self.message_ids.append(message.message_id)
+                self.sent_parts.append(part)
+            elif self.sent_parts[i] != part or markup is not None:
+                try:
+                    await bot.edit_message_text(part, chat_id=self.chat_id, message_id=self.message_ids[i], reply_markup=markup)
+                except TelegramBadRequest as e:
+                    if "message is not modified" not in str(e):
+                        raise
+                self.sent_parts[i] = part
+        del self.sent_parts[len(parts):]
+        self.last_flush = time.monotonic()
+
+QUANTITY_RE = re.compile(
+    r'\d+(?:[.,/]\d+)?\s*(?:кг|гр|г|мл|л|шт|ст\.?\s*л|ч\.?\s*л|стакан\w*|зубч\w*|пуч\w*)?\.?(?=\s|$)'
+)
 
-        diet_info = DIET_RULES.get(data['diet_type'], DIET_RULES["🚫 Нет ограничений"])
-        diet_description = diet_info["description"]
-        
+def ingredient_name(item: str) -> str:
+    return " ".join(QUANTITY_RE.sub(" ", item.lower()).split())
+
+def ingredient_set(ingredients: str) -> frozenset:
+    return frozenset(name for name in map(ingredient_name, ingredients.split(',')) if name)
+
+def recipe_combo(data: dict) -> tuple:
+    return (data['meal_time'], data['cuisine'], data['diet_type'])
+
+class ComboPopularity:
+    """Популярность сочетаний (приём пищи, кухня, диета) и наборов ингредиентов внутри них с затуханием"""
+
+    def __init__(self, max_combos: int, max_sets: int, decay: float):
+        self.max_combos = max_combos
+        self.max_sets = max_sets
+        self.decay = decay
+        self.combos = {}
+        self.sets = {}
+
+    def observe(self, data: dict):
         if data['diet_type'] == "⚠️ Аллергии":
-            diet_description = diet_description.format(allergies=data.get('allergies', ''))
-        
-        prompt_lines = [
-            "Ты профессиональный шеф-повар. Сгенерируй рецепт по следующим параметрам:",
-            "",
-            f"Тип блюда: {data['meal_time']}",
-            f"Кухня: {data['cuisine']}",
-            f"Диета: {data['diet_type']} ({diet_description})",
-            f"Исходные ингредиенты: {data['ingredients']}",
-            "",
-            "Требования:",
-            "- Строго соблюдай диетические ограничения",
-            "- Если ингредиенты не подходят - замени их",
-            "- Никогда не предлагай поискать в интернете",
-            "",
-            "Формат ответа (обязателен):",
-            "🍽 Название блюда",
-            f"🌍 Кухня: {data['cuisine']}",
-            f"🥗 Диета: {data['diet_type']}",
-            "⏱ Время приготовления: [время]",
-            "👨‍🍳 Порций: [число]",
-            "",
-            "📋 Ингредиенты (на 1 порцию):",
-            "- [название] [количество]",
-            "",
-            "🔪 Приготовление:",
-            "1. [шаг 1]",
-            "2. [шаг 2]",
-            "",
-            "📊 КБЖУ на порцию:",
-            "- Калории: [значение]",
-            "- Белки: [значение]",
-            "- Жиры: [значение]",
-            "- Углеводы: [значение]",
-            "",
-            "💡 Советы:",
-            "- [полезный совет]"
+            return
+        combo = recipe_combo(data)
+        self.combos[combo] = self.combos.get(combo, 0.0) + 1
+        sets = self.sets.setdefault(combo, {})
+        ingredients = ingredient_set(data['ingredients'])
+        sets[ingredients] = sets.get(ingredients, 0.0) + 1
+        if len(sets) > self.max_sets:
+            del sets[min((s for s in sets if s != ingredients), key=sets.get)]
+        if len(self.combos) > self.max_combos:
+            rare = min((c for c in self.combos if c != combo), key=self.combos.get)
+            del self.combos[rare]
+            self.sets.pop(rare, None)
+
+    def age(self):
+        for combo in self.combos:
+            self.combos[combo] *= self.decay
+        for sets in self.sets.values():
+            for ingredients in sets:
+                sets[ingredients] *= self.decay
+
+    def top(self, combos: int, sets: int) -> list:
+        ranked = sorted(self.combos, key=self.combos.get, reverse=True)[:combos]
+        return [
+            (combo, sorted(self.sets.get(combo, {}), key=self.sets[combo].get, reverse=True)[:sets])
+            for combo in ranked
         ]
 
-        prompt = "\n".join(prompt_lines)
+class RecipePool:
+    """Заранее сгенерированные рецепты: выдаются, если у пользователя есть все ингредиенты варианта"""
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Api-Key {YANDEX_API_KEY}"
-        }
+    def __init__(self, variants: int):
+        self.variants = variants
+        self.served = 0
+        self._pool = {}
 
-        body = {
-            "modelUri": f"gpt://{YANDEX_FOLDER_ID}/yandexgpt-lite",
-            "completionOptions": {
-                "stream": False,
-                "temperature": 0.5,
-                "maxTokens": 2000
-            },
-            "messages": [
-                {
-                    "role": "system",
-                    "text": "Ты профессиональный шеф-повар. Всегда генерируй рецепты. Никогда не предлагай поискать в интернете. Строго соблюдай формат."
-                },
-                {
-                    "role": "user",
-                    "text": prompt
-                }
-            ]
+    def __len__(self):
+        return sum(len(variants) for variants in self._pool.values())
+
+    def has(self, combo: tuple, ingredients: frozenset) -> bool:
+        return any(source == ingredients for source, _ in self._pool.get(combo, ()))
+
+    def add(self, combo: tuple, ingredients: frozenset, recipe: str):
+        variants = self._pool.setdefault(combo, [])
+        variants.append((ingredients, recipe))
+        del variants[:-self.variants]
+
+    def take(self, data: dict):
+        variants = self._pool.get(recipe_combo(data))
+        if not variants:
+            return None
+        available = ingredient_set(data['ingredients'])
+        for i, (source, recipe) in enumerate(variants):
+            if source <= available:
+                del variants[i]
+                self.served += 1
+                return recipe
+        return None
+
+combo_popularity = ComboPopularity(WARMER_TRACK_COMBOS, WARMER_TRACK_SETS, WARMER_DECAY)
+recipe_pool = RecipePool(WARMER_VARIANTS)
+
+def warmer_has_capacity() -> bool:
+    # Прогрев не конкурирует с живыми запросами: только при малой нагрузке и с запасом квоты YandexGPT
+    return (
+        GENERATIONS_IN_FLIGHT.value() < WARMER_MAX_LIVE
+        and yandex_limiter.available() >= WARMER_TOKEN_RESERVE / limit_share
+    )
+
+async def warm_variant(combo: tuple, ingredients: frozenset, limit: asyncio.Semaphore):
+    async with limit:
+        if not warmer_has_capacity():
+            return
+        meal_time, cuisine, diet_type = combo
+        data = {
+            "meal_time": meal_time,
+            "cuisine": cuisine,
+            "diet_type": diet_type,
+            "allergies": "",
+            "ingredients": ", ".join(sorted(ingredients))
         }
+        try:
+            recipe_pool.add(combo, ingredients, await request_recipe(data))
+        except Exception as e:
+            logger.error("Ошибка прогрева рецепта: %s", e, extra={"stage": "warmer"})
 
-        async with httpx.AsyncClient(timeout=90.0) as client:
-            yandex_response = await safe_api_call(
-                client.post,
-                "https://llm.api.cloud.yandex.net/foundationModels/v1/completion",
-                headers=headers,
-                data=json.dumps(body)
+async def run_warmer():
+    limit = asyncio.Semaphore(max(1, WARMER_CONCURRENCY // limit_share))
+    while True:
+        await asyncio.sleep(WARMER_INTERVAL)
+        combo_popularity.age()
+        if not warmer_has_capacity():
+            continue
+        jobs = [
+            warm_variant(combo, ingredients, limit)
+            for combo, sets in combo_popularity.top(WARMER_TOP_COMBOS, WARMER_VARIANTS)
+            for ingredients in sets
+            if ingredients and not recipe_pool.has(combo, ingredients)
+        ]
+        if jobs:
+            await asyncio.gather(*jobs)
+
+RECIPE_SECTIONS = (
+    ("📋", "ingredients"),
+    ("🔪", "steps"),
+    ("📊", "nutrition"),
+    ("💡", "tips")
+)
+BULLET_RE = re.compile(r'^[-•*]\s*')
+STEP_RE = re.compile(r'^\d+[.)]\s*')
+INGREDIENT_RE = re.compile(r'^(.*?)[\s—–:-]*(\d.*)?$')
+WORD_RE = re.compile(r'[а-яё]+')
+WORD_ENDINGS = ("ами", "ями", "ого", "ему", "ый", "ое", "ых", "ой", "ей", "ом", "ем", "ов", "ев", "ах", "ях", "ые", "ий", "ая", "а", "я", "ы", "и", "о", "е", "у", "ю")
+STAPLE_TERMS = frozenset(("сол", "соль", "перец", "перц", "вод", "сахар", "специ", "вкус", "черн", "молот"))
+
+def stem(word: str) -> str:
+    for ending in WORD_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+def ingredient_terms(name: str) -> frozenset:
+    return frozenset(stem(word) for word in WORD_RE.findall(ingredient_name(name)) if len(word) >= 3)
+
+def parse_ingredient(line: str) -> list:
+    # Количество бывает и после названия («Мука — 200 г»), и перед ним («200 г муки»)
+    leading = QUANTITY_RE.match(line)
+    if leading:
+        return [line[leading.end():].strip(" —–:-"), leading.group().strip()]
+    name, quantity = INGREDIENT_RE.match(line).groups()
+    return [name.strip(" —–:-"), quantity or ""]
+
+def parse_recipe(text: str):
+    record = {"title": "", "time": "", "servings": "", "ingredients": [], "steps": [], "nutrition": {}, "tips": []}
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        marker = next((name for prefix, name in RECIPE_SECTIONS if line.startswith(prefix)), None)
+        if marker is not None:
+            section = marker
+        elif line.startswith("🍽") and section is None:
+            # Заголовок постобработки идёт перед настоящим названием, поэтому берём последнее
+            record["title"] = line.lstrip("🍽").strip()
+        elif line.startswith("⏱") and ":" in line:
+            record["time"] = line.split(":", 1)[1].strip()
+        elif line.startswith("👨‍🍳") and ":" in line:
+            record["servings"] = line.split(":", 1)[1].strip()
+        elif section == "ingredients" and BULLET_RE.match(line):
+            record["ingredients"].append(parse_ingredient(BULLET_RE.sub("", line)))
+        elif section == "steps" and STEP_RE.match(line):
+            record["steps"].append(STEP_RE.sub("", line))
+        elif section == "nutrition" and ":" in line:
+            key, value = BULLET_RE.sub("", line).split(":", 1)
+            record["nutrition"][key.strip()] = value.strip()
+        elif section == "tips" and BULLET_RE.match(line):
+            record["tips"].append(BULLET_RE.sub("", line))
+    if not record["title"] or not record["ingredients"] or not record["steps"]:
+        return None
+    if not all(name for name, _ in record["ingredients"]):
+        return None
+    return record
+
+def format_recipe(record: dict, cuisine: str, diet_type: str) -> str:
+    lines = [
+        f"🍽 {record['title']}",
+        f"🌍 Кухня: {cuisine}",
+        f"🥗 Диета: {diet_type}",
+        f"⏱ Время приготовления: {record['time']}",
+        f"👨‍🍳 Порций: {record['servings']}",
+        "",
+        "📋 Ингредиенты (на 1 порцию):",
+        *(f"- {name} {quantity}".rstrip() for name, quantity in record["ingredients"]),
+        "",
+        "🔪 Приготовление:",
+        *(f"{i}. {step}" for i, step in enumerate(record["steps"], 1))
+    ]
+    if record["nutrition"]:
+        lines += ["", "📊 КБЖУ на порцию:", *(f"- {key}: {value}" for key, value in record["nutrition"].items())]
+    if record["tips"]:
+        lines += ["", "💡 Советы:", *(f"- {tip}" for tip in record["tips"])]
+    return "\n".join(lines)
+
+def missing_ingredients(record: dict, available: frozenset) -> list:
+    missing = []
+    for name, _ in record["ingredients"]:
+        # Ингредиент есть, только если совпали все его слова: «масло подсолнечное» не заменяет «масло сливочное»
+        terms = ingredient_terms(name)
+        if not terms or not terms <= available | STAPLE_TERMS:
+            missing.append(name)
+    return missing
+
+class RecipeStore:
+    """Разобранные рецепты на диске с инвертированным индексом по ингредиентам"""
+    PURGE_EVERY = 64
+
+    def __init__(self, path: str, max_recipes: int, lookup_limit: int):
+        self.max_recipes = max_recipes
+        self.lookup_limit = lookup_limit
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS recipes ("
+            "id INTEGER PRIMARY KEY, meal_time TEXT NOT NULL, cuisine TEXT NOT NULL, diet_type TEXT NOT NULL, "
+            "title TEXT NOT NULL, data TEXT NOT NULL, created_at REAL NOT NULL, "
+            "UNIQUE (cuisine, diet_type, meal_time, title))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS recipe_terms ("
+            "term TEXT NOT NULL, recipe_id INTEGER NOT NULL, PRIMARY KEY (term, recipe_id)) WITHOUT ROWID"
+        )
+
+    def save(self, data: dict, record: dict) -> bool:
+        terms = set()
+        for name, _ in record["ingredients"]:
+            terms |= ingredient_terms(name)
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO recipes (meal_time, cuisine, diet_type, title, data, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (data['meal_time'], data['cuisine'], data['diet_type'], record["title"],
+                 json.dumps(record, ensure_ascii=False, separators=(",", ":")), time.time())
+            )
+            if not cursor.rowcount:
+                return False
+            recipe_id = cursor.lastrowid
+            self._db.executemany(
+                "INSERT OR IGNORE INTO recipe_terms (term, recipe_id) VALUES (?, ?)",
+                [(term, recipe_id) for term in terms]
             )
+            self.saved += 1
+            if self.saved % self.PURGE_EVERY == 0:
+                self._purge()
+        return True
+
+    def _purge(self):
+        self._db.execute(
+            "DELETE FROM recipes WHERE id IN (SELECT id FROM recipes ORDER BY id DESC LIMIT -1 OFFSET ?)",
+            (self.max_recipes,)
+        )
+        self._db.execute("DELETE FROM recipe_terms WHERE recipe_id NOT IN (SELECT id FROM recipes)")
+
+    def search(self, available: frozenset, cuisine=None, diet_type=None, meal_time=None, limit: int = 3) -> list:
+        if not available:
+            return []
+        query = (
+            "SELECT cuisine, diet_type, data FROM recipes WHERE id IN ("
+            f"SELECT recipe_id FROM recipe_terms WHERE term IN ({', '.join('?' * len(available))}))"
+        )
+        params = list(available)
+        for column, value in (("cuisine", cuisine), ("diet_type", diet_type), ("meal_time", meal_time)):
+            if value is not None:
+                query += f" AND {column} = ?"
+                params.append(value)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(self.lookup_limit)
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        matches = []
+        for row_cuisine, row_diet, raw in rows:
+            record = json.loads(raw)
+            missing = missing_ingredients(record, available)
+            matches.append((len(missing), -len(record["ingredients"]), row_cuisine, row_diet, record, missing))
+        matches.sort(key=lambda match: match[:2])
+        return [(record, row_cuisine, row_diet, missing) for _, _, row_cuisine, row_diet, record, missing in matches[:limit]]
+
+    def find(self, data: dict):
+        # Готовый рецепт выдаётся только тем же параметрам и если у пользователя есть все ингредиенты
+        if data['diet_type'] == "⚠️ Аллергии":
+            return None
+        available = frozenset().union(*map(ingredient_terms, data['ingredients'].split(',')))
+        matches = self.search(available, data['cuisine'], data['diet_type'], data['meal_time'], limit=1)
+        if matches and not matches[0][3]:
+            self.hits += 1
+            record, cuisine, diet_type, _ = matches[0]
+            return format_recipe(record, cuisine, diet_type)
+        self.misses += 1
+        return None
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "saved": self.saved}
+
+    def close(self):
+        self._db.close()
+
+def create_recipe_store():
+    return RecipeStore(RECIPE_DB_PATH, RECIPE_STORE_MAX, RECIPE_LOOKUP_LIMIT) if RECIPE_DB_PATH else None
+
+recipe_store = None
+store_writes = set()
+
+def remember_recipe(data: dict, recipe: str):
+    if recipe_store is None:
+        return
+    record = parse_recipe(recipe)
+    if record is None:
+        logger.warning("Не удалось разобрать рецепт для хранилища")
+        return
+    task = asyncio.ensure_future(asyncio.to_thread(recipe_store.save, data, record))
+    store_writes.add(task)
+    task.add_done_callback(_log_store_error)
+
+def _log_store_error(task: asyncio.Task):
+    store_writes.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Ошибка сохранения рецепта: %s", task.exception(), extra={"stage": "recipe_store"})
+
+async def close_recipe_store():
+    # Запись в базу идёт в фоновых потоках: закрываем соединение только после них
+    if recipe_store is None:
+        return
+    await asyncio.gather(*store_writes, return_exceptions=True)
+    recipe_store.close()
+
+async def fetch_recipe(data: dict, on_partial=None) -> str:
+    recipe = recipe_pool.take(data)
+    if recipe is not None:
+        return recipe
+    if recipe_store is not None:
+        with STAGE_SECONDS.time("recipe_store"):
+            recipe = await asyncio.to_thread(recipe_store.find, data)
+        if recipe is not None:
+            return recipe
+    return await request_recipe(data, on_partial)
+
+class GenerationRegistry:
+    """Текущая генерация рецепта каждого чата, чтобы новый запрос мог отменить устаревший"""
+
+    def __init__(self):
+        self.superseded = 0
+        self._tasks = {}
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def active(self, chat_id: int) -> bool:
+        task = self._tasks.get(chat_id)
+        return task is not None and not task.done()
+
+    def chats(self) -> list:
+        return [chat_id for chat_id, task in self._tasks.items() if not task.done()]
+
+    def cancel(self, chat_id: int) -> bool:
+        if not self.active(chat_id):
+            return False
+        self._tasks[chat_id].cancel()
+        self.superseded += 1
+        return True
 
-            result = yandex_response.json()
-            recipe = ensure_russian(result['result']['alternatives'][0]['message']['text'])
+    async def run(self, chat_id: int, coro):
+        self.cancel(chat_id)
+        task = asyncio.ensure_future(coro)
+        self._tasks[chat_id] = task
+        try:
+            return await task
+        finally:
+            if self._tasks.get(chat_id) is task:
+                del self._tasks[chat_id]
+
+generations = GenerationRegistry()
+
+async def generate_recipe(chat_id: int):
+    try:
+        await generations.run(chat_id, _generate_recipe(chat_id))
+    except asyncio.CancelledError:
+        # Отменили саму обработку апдейта (остановка бота) — пробрасываем, иначе генерацию вытеснил новый запрос
+        if asyncio.current_task().cancelling():
+            raise
+        logger.info("Генерация отменена новым запросом", extra={"chat_id": chat_id, "stage": "generate"})
 
-            if "интернет" in recipe.lower() or "поиск" in recipe.lower():
-                recipe = "🍽 Рецепт (адаптированный под ваши параметры)\n\n" + recipe
-                recipe = recipe.replace("Вы можете найти рецепты в интернете", "")
-                recipe = recipe.replace("Посмотрите в поиске", "")
+async def _generate_recipe(chat_id: int):
+    GENERATIONS_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    try:
+        data = (await state_store.get(chat_id)).to_dict()
+        await bot.send_chat_action(chat_id, 'typing')
+
+        combo_popularity.observe(data)
+        streamer = RecipeStreamer(chat_id) if YANDEX_STREAM else None
+        recipe = await recipe_cache.get_or_fetch(
+            recipe_cache_key(data),
+            lambda: fetch_recipe(data, streamer.update if streamer else None)
+        )
+        if DEBUG:
+            logger.info("Кэш рецептов: %s", recipe_cache.stats())
 
         markup = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🍳 Наш кулинарный канал", url=CHANNEL_LINK)]
         ])
 
-        if len(recipe) > 4000:
-            parts = [recipe[i:i+4000] for i in range(0, len(recipe), 4000)]
-            for part in parts:
-                await bot.send_message(chat_id, part, reply_markup=markup)
-                await asyncio.sleep(0.5)
+        if streamer and streamer.message_ids:
+            await streamer.finish(recipe, markup)
         else:
-            await bot.send_message(chat_id, recipe, reply_markup=markup)
+            for part in split_message(recipe):
+                await bot.send_message(chat_id, part, reply_markup=markup)
             
-        await bot.send_message(chat_id, "Что будем делать дальше?", reply_markup=main_keyboard())
+        await bot.send_message(chat_id, "Что будем делать дальше?", reply_markup=MAIN_KEYBOARD)
+        logger.info(
+            "Рецепт отправлен",
+            extra={"chat_id": chat_id, "stage": "generate", "latency": round(time.perf_counter() - started, 3), "sampled": True}
+        )
 
     except Exception as e:
-        logger.error(f"Ошибка генерации: {e}")
-        await bot.send_message(chat_id, "⚠️ Произошла ошибка при генерации рецепта. Пожалуйста, попробуйте еще раз.", reply_markup=main_keyboard())
+        ERRORS.inc("generate", type(e).__name__)
+        logger.error("Ошибка генерации: %s", e, extra={"chat_id": chat_id, "stage": "generate"})
+        await bot.send_message(chat_id, "⚠️ Произошла ошибка при генерации рецепта. Пожалуйста, попробуйте еще раз.", reply_markup=MAIN_KEYBOARD)
+    finally:
+        GENERATIONS_IN_FLIGHT.dec()
 
-@dp.message()
+@router.message()
 async def fallback(message: types.Message):
-    await message.answer("Используйте кнопку «🍳 Создать рецепт» или /start", reply_markup=main_keyboard())
+    await message.answer("Используйте кнопку «🍳 Создать рецепт» или /start", reply_markup=MAIN_KEYBOARD)
+
+def update_chat_id(update: types.Update) -> int:
+    try:
+        event = update.event
+    except Exception:
+        return 0
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, 'from_user', None)
+    return user.id if user is not None else 0
+
+class UpdateQueue:
+    """Ограниченная очередь апдейтов: апдейты одного чата обрабатываются строго по порядку, разные чаты — параллельно"""
+
+    def __init__(self, process, workers: int, max_pending: int):
+        self._process = process
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.shed = 0
+        self._chats = {}
+        self._active = set()
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._chats.clear()
+        self._active.clear()
+        self._ready = asyncio.Queue()
+        self.pending = 0
+        self._idle.set()
+
+    def submit(self, chat_id: int, update: types.Update) -> bool:
+        if self.pending >= self.max_pending:
+            self.shed += 1
+            return False
+        self.pending += 1
+        self._idle.clear()
+        updates = self._chats.get(chat_id)
+        if updates is None:
+            self._chats[chat_id] = deque([update])
+            self._ready.put_nowait(chat_id)
+        else:
+            # Чат уже в очереди или обрабатывается: новый апдейт дождётся своей очереди у того же чата
+            updates.append(update)
+        return True
+
+    async def join(self):
+        await self._idle.wait()
+
+    def snapshot(self) -> list:
+        # Только ещё не начатые апдейты: обрабатываемый сейчас апдейт чата стоит первым в его очереди
+        return [
+            (chat_id, item)
+            for chat_id, updates in self._chats.items()
+            for item in list(updates)[1 if chat_id in self._active else 0:]
+        ]
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            updates = self._chats[chat_id]
+            self._active.add(chat_id)
+            try:
+                await self._process(updates[0])
+            except Exception as e:
+                ERRORS.inc("update", type(e).__name__)
+                logger.error("Ошибка обработки апдейта: %s", e, extra={"chat_id": chat_id, "stage": "update"})
+            finally:
+                self._active.discard(chat_id)
+                updates.popleft()
+                self.pending -= 1
+                if not self.pending:
+                    self._idle.set()
+                if updates:
+                    self._ready.put_nowait(chat_id)
+                else:
+                    del self._chats[chat_id]
+
+@dataclass(slots=True, frozen=True)
+class ResumedGeneration:
+    """Генерация, прерванная перезапуском: ставится в очередь чата раньше его сохранённых апдейтов"""
+    chat_id: int
+
+async def process_update(item):
+    if isinstance(item, ResumedGeneration):
+        await bot.send_message(item.chat_id, "🔄 Бот перезапустился, продолжаю генерировать рецепт...")
+        await generate_recipe(item.chat_id)
+    else:
+        await dp.feed_update(bot=bot, update=item)
+
+update_queue = UpdateQueue(
+    process_update,
+    UPDATE_WORKERS,
+    UPDATE_QUEUE_SIZE
+)
+busy_replies = set()
+
+class RecentUpdates:
+    """Ограниченное множество недавно полученных update_id для отсева повторных доставок Telegram"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.duplicates = 0
+        self._seen = set()
+        self._order = deque()
+
+    def add(self, update_id) -> bool:
+        if update_id in self._seen:
+            self.duplicates += 1
+            return False
+        self._seen.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.size:
+            self._seen.discard(self._order.popleft())
+        return True
+
+recent_updates = RecentUpdates(RECENT_UPDATES_SIZE)
+MENU_BUTTONS = frozenset(("📜 Публичная оферта", "📢 Наш кулинарный канал")) | MEAL_TIME_CHOICES | CUISINE_CHOICES | DIET_CHOICES
+
+async def supersedes_generation(update: types.Update, chat_id: int) -> bool:
+    message = update.message
+    if message is None or message.text is None or not generations.active(chat_id):
+        return False
+    if message.text == "🍳 Создать рецепт":
+        return True
+    if message.text in MENU_BUTTONS or message.text.startswith("/"):
+        return False
+    # Пока идёт генерация, чат остаётся на шаге ингредиентов: новый текст — это новый список продуктов
+    state = await state_store.get(chat_id)
+    return state is not None and state.step == "waiting_ingredients"
+
+def collect_runtime_stats():
+    for stat, value in recipe_cache.stats().items():
+        RECIPE_CACHE_EVENTS.set(stat, value=value)
+    UPDATE_QUEUE_STATS.set("pending", value=update_queue.pending)
+    UPDATE_QUEUE_STATS.set("shed", value=update_queue.shed)
+    UPDATE_QUEUE_STATS.set("duplicates", value=recent_updates.duplicates)
+    UPDATE_QUEUE_STATS.set("superseded", value=generations.superseded)
+    RECIPE_POOL_STATS.set("size", value=len(recipe_pool))
+    RECIPE_POOL_STATS.set("served", value=recipe_pool.served)
+    if recipe_store is not None:
+        for stat, value in recipe_store.stats().items():
+            RECIPE_STORE_STATS.set(stat, value=value)
+
+metrics.collectors.append(collect_runtime_stats)
+
+async def send_busy_reply(chat_id: int):
+    try:
+        await bot.send_message(chat_id, "⏳ Сейчас очень много запросов. Пожалуйста, попробуйте через минуту.")
+    except Exception as e:
+        logger.error("Не удалось отправить ответ о перегрузке: %s", e, extra={"chat_id": chat_id})
+
+def shed_update(update: types.Update, chat_id: int):
+    if update.message is None or len(busy_replies) >= MAX_BUSY_REPLIES:
+        return
+    task = asyncio.create_task(send_busy_reply(chat_id))
+    busy_replies.add(task)
+    task.add_done_callback(busy_replies.discard)
+
+@dataclass(slots=True)
+class Lifecycle:
+    ready: bool = False
+    draining: bool = False
+
+lifecycle = Lifecycle()
+
+async def handle_healthz(request):
+    return web.Response(text="OK")
+
+async def handle_readyz(request):
+    if lifecycle.ready and not lifecycle.draining:
+        return web.Response(text="OK")
+    return web.Response(text="Not ready", status=503)
 
 async def handle_webhook(request):
+    if lifecycle.draining:
+        # Telegram повторит доставку, и апдейт примет уже новый процесс
+        return web.Response(text="Draining", status=503)
     try:
-        update_data = await request.json()
-        update = types.Update(**update_data)
-        await dp.feed_update(bot=bot, update=update)
+        with STAGE_SECONDS.time("webhook"):
+            update_data = await request.json()
+            if not recent_updates.add(update_data.get("update_id")):
+                logger.info("Повторная доставка апдейта пропущена", extra={"update_id": update_data.get("update_id"), "stage": "webhook"})
+                return web.Response(text="OK", status=200)
+            update = types.Update.model_validate(update_data, context={"bot": bot})
+            chat_id = update_chat_id(update)
+            # Апдейты чата обрабатываются по порядку, поэтому устаревшую генерацию отменяем до постановки в очередь
+            if await supersedes_generation(update, chat_id):
+                generations.cancel(chat_id)
+            # Отвечаем Telegram сразу, иначе долгая генерация приводит к таймауту и повторной доставке
+            if not update_queue.submit(chat_id, update):
+                logger.warning(
+                    "Очередь переполнена, апдейт отброшен",
+                    extra={"chat_id": chat_id, "update_id": update.update_id, "stage": "webhook"}
+                )
+                shed_update(update, chat_id)
         return web.Response(text="OK", status=200)
     except Exception as e:
-        logger.error(f"Webhook error: {e}")
+        ERRORS.inc("webhook", type(e).__name__)
+        logger.error("Webhook error: %s", e, extra={"stage": "webhook"})
         return web.Response(text="Error", status=500)
 
-async def on_startup(bot: Bot):
+async def set_webhook(bot: Bot):
     webhook_url = os.getenv('WEBHOOK_URL')
     if webhook_url:
-        await bot.set_webhook(url=f"{webhook_url}/webhook", drop_pending_updates=True)
-        logger.info(f"Вебхук установлен: {webhook_url}")
+        # Апдейты, накопленные за время перезапуска, не выбрасываем
+        await bot.set_webhook(url=f"{webhook_url}/webhook", drop_pending_updates=False)
+        logger.info("Вебхук установлен: %s", webhook_url)
     else:
         logger.warning("WEBHOOK_URL не указан!")
 
-async def main():
+async def on_startup(bot: Bot):
+    get_yandex_client()
+    await set_webhook(bot)
+
+def create_app() -> web.Application:
+    global bot, dp, state_store, recipe_store
+    configure()
+    bot = create_bot()
+    dp = Dispatcher()
+    dp.include_router(router)
+    state_store = create_state_store()
+    recipe_store = create_recipe_store()
+    app = web.Application()
     app.router.add_post('/webhook', handle_webhook)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/healthz', handle_healthz)
+    app.router.add_get('/readyz', handle_readyz)
     setup_application(app, dp, bot=bot)
-    await on_startup(bot)
+    return app
+
+def pending_prefix(worker_index: int = None) -> str:
+    return os.path.join(PENDING_DIR, f"kitchen_pending_{'main' if worker_index is None else worker_index}")
+
+async def save_pending(prefix: str, generating: list, queued: list):
+    chats = set(generating)
+    updates = []
+    for chat_id, item in queued:
+        chats.add(chat_id)
+        if isinstance(item, ResumedGeneration):
+            generating.append(chat_id)
+        else:
+            updates.append(item.model_dump(mode="json", exclude_none=True, by_alias=True))
+    states = {}
+    for chat_id in chats:
+        state = await state_store.get(chat_id)
+        if state is not None:
+            states[str(chat_id)] = state.to_dict()
+    if not generating and not updates:
+        return
+    # Свой файл у каждого процесса: при перекрывающемся перезапуске старый и новый не затирают друг друга
+    path = f"{prefix}.{os.getpid()}.json"
+    with open(path + ".tmp", 'w', encoding='utf-8') as output:
+        json.dump(
+            {"saved_at": time.time(), "generations": generating, "updates": updates, "states": states},
+            output,
+            ensure_ascii=False
+        )
+    os.replace(path + ".tmp", path)
+    logger.info("Сохранено до перезапуска: генераций %s, апдейтов %s", len(generating), len(updates))
+
+def claim_pending(prefix: str) -> list:
+    claimed = []
+    for path in glob.glob(glob.escape(prefix) + ".*.json"):
+        claim = f"{path}.claimed-{os.getpid()}"
+        try:
+            # rename атомарен: файл достаётся ровно одному из процессов, которые его увидели
+            os.rename(path, claim)
+        except FileNotFoundError:
+            continue
+        try:
+            with open(claim, encoding='utf-8') as source:
+                claimed.append(json.load(source))
+        except ValueError as e:
+            logger.error("Не удалось прочитать незавершённые запросы: %s", e)
+        finally:
+            os.remove(claim)
+    return claimed
+
+async def resume_pending(prefix: str):
+    for pending in claim_pending(prefix):
+        age = time.time() - pending.get("saved_at", 0)
+        if age > PENDING_MAX_AGE:
+            logger.warning(
+                "Незавершённые запросы пропущены: сохранены %d с назад, генераций %s, апдейтов %s",
+                age, len(pending["generations"]), len(pending["updates"])
+            )
+            continue
+        for chat_id, state in pending["states"].items():
+            if await state_store.get(int(chat_id)) is None:
+                await state_store.set(int(chat_id), ChatState(**state))
+        # Прерванная генерация чата шла раньше его необработанных апдейтов, поэтому и в очередь встаёт первой
+        for chat_id in pending["generations"]:
+            update_queue.submit(chat_id, ResumedGeneration(chat_id))
+        for data in pending["updates"]:
+            update = types.Update.model_validate(data, context={"bot": bot})
+            recent_updates.add(update.update_id)
+            update_queue.submit(update_chat_id(update), update)
+        logger.info("Восстановлено после перезапуска: генераций %s, апдейтов %s", len(pending["generations"]), len(pending["updates"]))
+
+async def watch_pending(prefix: str):
+    # При перезапуске без простоя старый процесс сохраняет остаток уже после старта нового
+    while not lifecycle.draining:
+        await resume_pending(prefix)
+        await asyncio.sleep(PENDING_POLL_INTERVAL)
+
+async def drain(prefix: str):
+    lifecycle.draining = True
+    try:
+        await asyncio.wait_for(update_queue.join(), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Очередь не опустела за %s с, незавершённое сохраняется до следующего запуска", DRAIN_TIMEOUT)
+    # Между снимком и остановкой нет await, поэтому ни одна сохранённая генерация не успеет завершиться дважды
+    generating, queued = generations.chats(), update_queue.snapshot()
+    await update_queue.stop()
+    await save_pending(prefix, generating, queued)
+
+def stop_event() -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    return stop
+
+async def main(worker_index: int = None, workers: int = 1):
+    share_limits(workers)
+    app = create_app()
+    stop = stop_event()
+    if worker_index is None:
+        await on_startup(bot)
+        port = int(os.getenv('WEBHOOK_PORT', 8000))
+    else:
+        # Вебхук ставит супервизор, воркер только слушает свой локальный порт
+        get_yandex_client()
+        port = WORKER_BASE_PORT + worker_index
     runner = web.AppRunner(app)
     await runner.setup()
+    site = web.TCPSite(runner, host='127.0.0.1', port=port, reuse_port=True)
+    update_queue.start()
+    watcher = asyncio.create_task(watch_pending(pending_prefix(worker_index)))
+    warmer = asyncio.create_task(run_warmer()) if WARMER_INTERVAL > 0 else None
+    await site.start()
+    lifecycle.ready = True
+    logger.info("Сервер запущен на порту %s", port, extra={"worker": worker_index})
+    try:
+        await stop.wait()
+        logger.info("Остановка бота", extra={"worker": worker_index})
+        watcher.cancel()
+        await drain(pending_prefix(worker_index))
+    finally:
+        await runner.cleanup()
+        await update_queue.stop()
+        watcher.cancel()
+        if warmer is not None:
+            warmer.cancel()
+        await close_yandex_client()
+        state_store.close()
+        await close_recipe_store()
+        await bot.session.close()
+
+def raw_update_chat_id(data: dict) -> int:
+    for key, event in data.items():
+        if key == 'update_id' or not isinstance(event, dict):
+            continue
+        chat = event.get('chat') or (event.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        user = event.get('from')
+        if user:
+            return user['id']
+    return 0
+
+def worker_for(chat_id: int, workers: int) -> int:
+    return chat_id % workers
+
+def run_worker(worker_index: int, workers: int):
+    uvloop.install()
+    asyncio.run(main(worker_index, workers))
+
+async def supervise(workers: int):
+    global bot
+    configure()
+    bot = create_bot()
+    stop = stop_event()
+    # Каждый чат всегда попадает в один и тот же воркер, поэтому состояние диалога может жить в памяти воркера
+    context = multiprocessing.get_context("spawn")
+    processes = [None] * workers
+
+    def start_worker(index: int):
+        process = context.Process(target=run_worker, args=(index, workers), name=f"kitchen-worker-{index}", daemon=True)
+        process.start()
+        processes[index] = process
+
+    for index in range(workers):
+        start_worker(index)
+
+    session = ClientSession(timeout=ClientTimeout(total=10))
+
+    async def route_webhook(request):
+        if lifecycle.draining:
+            return web.Response(text="Draining", status=503)
+        try:
+            body = await request.read()
+            chat_id = raw_update_chat_id(json.loads(body))
+        except Exception as e:
+            logger.error("Webhook error: %s", e, extra={"stage": "webhook"})
+            return web.Response(text="Error", status=500)
+        port = WORKER_BASE_PORT + worker_for(chat_id, workers)
+        try:
+            async with session.post(f"http://127.0.0.1:{port}/webhook", data=body, headers={"Content-Type": "application/json"}) as response:
+                return web.Response(text=await response.text(), status=response.status)
+        except ClientError as e:
+            logger.error("Воркер на порту %s недоступен: %s", port, e, extra={"chat_id": chat_id})
+            return web.Response(text="Worker unavailable", status=503)
+
+    async def worker_ready(index: int) -> bool:
+        try:
+            async with session.get(f"http://127.0.0.1:{WORKER_BASE_PORT + index}/readyz", timeout=ClientTimeout(total=1)) as response:
+                return response.status == 200
+        except (ClientError, asyncio.TimeoutError):
+            return False
+
+    async def workers_ready() -> bool:
+        return all(await asyncio.gather(*(worker_ready(index) for index in range(workers))))
+
+    async def supervisor_readyz(request):
+        # Супервизор готов, только когда готовы все воркеры, которым он пересылает апдейты
+        if lifecycle.ready and not lifecycle.draining and await workers_ready():
+            return web.Response(text="OK")
+        return web.Response(text="Not ready", status=503)
+
+    router_app = web.Application()
+    router_app.router.add_post('/webhook', route_webhook)
+    router_app.router.add_get('/healthz', handle_healthz)
+    router_app.router.add_get('/readyz', supervisor_readyz)
+    runner = web.AppRunner(router_app)
+    await runner.setup()
     port = int(os.getenv('WEBHOOK_PORT', 8000))
     site = web.TCPSite(runner, host='127.0.0.1', port=port, reuse_port=True)
     await site.start()
-    logger.info(f"Сервер запущен на порту {port}")
+    logger.info("Супервизор запущен на порту %s, воркеров: %s", port, workers)
     try:
-        while True:
-            await asyncio.sleep(3600)
-    except KeyboardInterrupt:
-        logger.info("Остановка бота")
+        while not stop.is_set():
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.error("Воркер завершился с кодом %s, перезапуск", process.exitcode, extra={"worker": index})
+                    start_worker(index)
+            # Вебхук ставим, только когда все воркеры слушают свои порты, иначе первые апдейты получат 503
+            if not lifecycle.ready and await workers_ready():
+                await set_webhook(bot)
+                lifecycle.ready = True
+                logger.info("Все воркеры готовы")
+            try:
+                await asyncio.wait_for(stop.wait(), 0.5 if not lifecycle.ready else 1)
+            except asyncio.TimeoutError:
+                pass
     finally:
+        lifecycle.draining = True
+        # SIGTERM воркерам: каждый дорабатывает свою очередь и сохраняет остаток на диск
+        for process in processes:
+            process.terminate()
+        await asyncio.gather(*(asyncio.to_thread(process.join, DRAIN_TIMEOUT + 5) for process in processes))
+        for process in processes:
+            if process.is_alive():
+                process.kill()
         await runner.cleanup()
+        await session.close()
         await bot.session.close()
 
+BATCH_FIELDS = ("meal_time", "cuisine", "diet_type", "allergies", "ingredients")
+
+def read_batch(path: str):
+    with open(path, encoding='utf-8-sig', newline='') as source:
+        if path.lower().endswith('.csv'):
+            yield from csv.DictReader(source)
+            return
+        for line in source:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Битая строка отдаётся как есть и попадает в результаты с ошибкой, а не обрывает прогон
+                yield line.strip()
+
+def batch_row(row) -> tuple:
+    if not isinstance(row, dict):
+        return None, "Строка не является объектом JSON"
+    data = {}
+    for field in BATCH_FIELDS:
+        value = row.get(field) or ""
+        if not isinstance(value, str):
+            return None, f"Поле {field} должно быть строкой"
+        data[field] = value.strip()
+    return data, None
+
+def batch_item_id(data: dict) -> str:
+    if data.get('id'):
+        return str(data['id'])
+    # Без явного id одинаковые параметры дают один и тот же id, как и ключ кэша рецептов
+    key = json.dumps(recipe_cache_key(data), ensure_ascii=False)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+def load_checkpoint(path: str) -> set:
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'rb+') as output:
+        for line in output:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # Строка, оборванная при аварийной остановке: элемент будет сгенерирован заново
+                continue
+            if result.get('status') == 'ok':
+                done.add(result['id'])
+        output.seek(0, os.SEEK_END)
+        if output.tell():
+            output.seek(-1, os.SEEK_END)
+            if output.read(1) != b'\n':
+                output.write(b'\n')
+    return done
+
+async def generate_batch_item(item_id: str, data: dict) -> dict:
+    result = {"id": item_id, **data}
+    if data['diet_type'] not in DIET_RULES or not data['ingredients']:
+        return dict(result, status="error", error="Неизвестная диета или пустой список ингредиентов")
+    with STAGE_SECONDS.time("diet_check"):
+        conflicts, _ = check_diet_conflicts(data['ingredients'], data['diet_type'], data['allergies'])
+    started = time.perf_counter()
+    try:
+        recipe = await request_recipe(data)
+    except Exception as e:
+        ERRORS.inc("batch", type(e).__name__)
+        logger.error("Ошибка генерации: %s", e, extra={"stage": "batch"})
+        return dict(result, status="error", error=f"{type(e).__name__}: {e}")
+    latency = round(time.perf_counter() - started, 3)
+    logger.info("Рецепт сгенерирован", extra={"stage": "batch", "latency": latency, "sampled": True})
+    return dict(result, status="ok", conflicts=conflicts, latency=latency, recipe=recipe, parsed=parse_recipe(recipe))
+
+async def run_batch(args):
+    global recipe_store
+    configure(BATCH_REQUIRED_KEYS)
+    recipe_store = create_recipe_store()
+    done = load_checkpoint(args.output)
+    counts = {"ok": 0, "error": 0, "skipped": 0}
+    # Очередь ограничена, поэтому входной файл читается по мере обработки, а не целиком
+    items = asyncio.Queue(maxsize=args.concurrency * 2)
+
+    def write_result(output, result: dict):
+        counts[result['status']] += 1
+        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output.flush()
+
+    async def worker(output):
+        while True:
+            item = await items.get()
+            if item is None:
+                return
+            write_result(output, await generate_batch_item(*item))
+
+    get_yandex_client()
+    try:
+        with open(args.output, 'a', encoding='utf-8') as output:
+            workers = [asyncio.create_task(worker(output)) for _ in range(args.concurrency)]
+            for number, row in enumerate(read_batch(args.input), 1):
+                data, error = batch_row(row)
+                if error is not None:
+                    item_id = str(row['id']) if isinstance(row, dict) and row.get('id') else f"line-{number}"
+                    logger.warning("Строка %s пропущена: %s", number, error, extra={"stage": "batch"})
+                    write_result(output, {"id": item_id, "status": "error", "error": error})
+                    continue
+                item_id = batch_item_id(dict(row, **data))
+                if item_id in done:
+                    counts["skipped"] += 1
+                    continue
+                done.add(item_id)
+                await items.put((item_id, data))
+            for _ in workers:
+                await items.put(None)
+            await asyncio.gather(*workers)
+    finally:
+        await close_yandex_client()
+        await close_recipe_store()
+    logger.info("Пакет завершён: готово %(ok)s, ошибок %(error)s, пропущено %(skipped)s", counts)
+
+def parse_batch_args(argv: list):
+    parser = argparse.ArgumentParser(prog="AI_Kitchen_bot.py batch", description="Пакетная генерация рецептов для канала")
+    parser.add_argument("input", help="CSV или JSONL с полями meal_time, cuisine, diet_type, allergies, ingredients и необязательным id")
+    parser.add_argument("-o", "--output", default="batch_recipes.jsonl", help="JSONL с результатами, он же чекпоинт для продолжения")
+    parser.add_argument("-c", "--concurrency", type=int, default=BATCH_CONCURRENCY, help="сколько рецептов генерируется одновременно")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
+    uvloop.install()
     try:
-        asyncio.run(main())
+        if sys.argv[1:2] == ["batch"]:
+            asyncio.run(run_batch(parse_batch_args(sys.argv[2:])))
+        elif WORKERS > 1:
+            asyncio.run(supervise(WORKERS))
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Бот остановлен")
     except Exception as e:
-        logger.error(f"Фатальная ошибка: {e}")
-
+        logger.error("Фатальная ошибка: %s", e)
+        sys.exit(1)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""Нагрузочный тест бота без обращения к продакшену.
+
+Поднимает в одном процессе заглушку YandexGPT, заглушку Telegram Bot API и
+сам бот, после чего прогоняет синтетических пользователей через полный
+сценарий (приём пищи → кухня → диета → ингредиенты) по HTTP через /webhook.
+
+Пример:
+    python benchmark.py --users 500 --concurrency 100 --llm-latency-ms 800 --llm-429-rate 0.05
+    python benchmark.py --output run.json --baseline baseline.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import random
+import socket
+import asyncio
+import argparse
+import itertools
+from aiohttp import ClientSession, web
+
+INGREDIENTS = (
+    "2 яйца", "100г муки", "1 ст.л. масла", "200мл молока", "курица", "рис", "макароны",
+    "картофель", "морковь", "лук", "помидоры", "сыр", "говядина", "рыба", "грибы",
+    "баклажаны", "свинина", "бекон", "сливки", "майонез", "нут", "шпинат", "творог"
+)
+ALLERGIES = ("орехи", "молоко", "яйца", "рыба", "мёд", "глютен")
+
+FINAL_REPLIES = (
+    "Что будем делать дальше?",
+    "⚠️ Произошла ошибка при генерации рецепта. Пожалуйста, попробуйте еще раз."
+)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def fake_recipe(rng: random.Random, length: int) -> str:
+    lines = [
+        "🍽 Омлет по-домашнему",
+        "🌍 Кухня: Русская",
+        "⏱ Время приготовления: 15 минут",
+        "👨‍🍳 Порций: 2",
+        "",
+        "📋 Ингредиенты (на 1 порцию):"
+    ]
+    lines += [f"- {item}" for item in rng.sample(INGREDIENTS, 5)]
+    lines += ["", "🔪 Приготовление:"]
+    step = 1
+    while sum(len(line) + 1 for line in lines) < length:
+        lines.append(f"{step}. Перемешайте ингредиенты и готовьте на среднем огне до готовности.")
+        step += 1
+    lines += ["", "📊 КБЖУ на порцию:", "- Калории: 250", "- Белки: 14", "- Жиры: 12", "- Углеводы: 20"]
+    return "\n".join(lines)
+
+
+class YandexStub:
+    """Заглушка llm.api.cloud.yandex.net с настраиваемыми задержкой, ошибками и 429"""
+
+    def __init__(self, rng: random.Random, latency_ms: float, jitter: float, error_rate: float,
+                 throttle_rate: float, retry_after: float, recipe_length: int):
+        self.rng = rng
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.recipe_length = recipe_length
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+
+    async def completion(self, request):
+        self.requests += 1
+        body = await request.json()
+        roll = self.rng.random()
+        if roll < self.throttle_rate:
+            self.throttled += 1
+            return web.json_response({"error": "rate limited"}, status=429, headers={"Retry-After": str(self.retry_after)})
+        if roll < self.throttle_rate + self.error_rate:
+            self.errors += 1
+            return web.json_response({"error": "internal"}, status=500)
+
+        latency = self.latency_ms / 1000 * self.rng.lognormvariate(0, self.jitter)
+        text = fake_recipe(self.rng, self.recipe_length)
+        usage = {"inputTextTokens": "350", "completionTokens": str(len(text) // 3), "totalTokens": str(350 + len(text) // 3)}
+
+        if not body.get("completionOptions", {}).get("stream"):
+            await asyncio.sleep(latency)
+            return web.json_response({"result": {
+                "alternatives": [{"message": {"role": "assistant", "text": text}, "status": "ALTERNATIVE_STATUS_FINAL"}],
+                "usage": usage
+            }})
+
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        chunks = 10
+        for i in range(1, chunks + 1):
+            await asyncio.sleep(latency / chunks)
+            chunk = {"result": {
+                "alternatives": [{"message": {"role": "assistant", "text": text[:len(text) * i // chunks]}}],
+                "usage": usage
+            }}
+            await response.write(json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n")
+        await response.write_eof()
+        return response
+
+
+class TelegramSink:
+    """Заглушка Telegram Bot API: отвечает как настоящий API и запоминает все исходящие сообщения"""
+
+    def __init__(self):
+        self.messages = {}
+        self.calls = 0
+        self._message_ids = itertools.count(1)
+        self._events = {}
+
+    async def handle(self, request):
+        self.calls += 1
+        method = request.match_info["method"].lower()
+        data = await request.post()
+        if method not in ("sendmessage", "editmessagetext"):
+            return web.json_response({"ok": True, "result": True})
+
+        chat_id = int(data["chat_id"])
+        message_id = int(data["message_id"]) if method == "editmessagetext" else next(self._message_ids)
+        self.messages.setdefault(chat_id, []).append((time.perf_counter(), method, data.get("text", "")))
+        event = self._events.get(chat_id)
+        if event is not None:
+            event.set()
+        return web.json_response({"ok": True, "result": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": data.get("text", "")
+        }})
+
+    def sent(self, chat_id: int) -> list:
+        return self.messages.get(chat_id, [])
+
+    async def wait(self, chat_id: int, predicate, timeout: float):
+        event = self._events.setdefault(chat_id, asyncio.Event())
+        deadline = time.perf_counter() + timeout
+        while not predicate(self.sent(chat_id)):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            event.clear()
+            await asyncio.wait_for(event.wait(), remaining)
+        return self.sent(chat_id)
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Бенчмарк"},
+            "text": text
+        }
+    }
+
+
+def wizard_flow(kitchen, rng: random.Random, unique: bool) -> list:
+    diet = rng.choice(kitchen.DIETS)
+    steps = ["🍳 Создать рецепт", rng.choice(kitchen.MEAL_TIMES), rng.choice(kitchen.CUISINES), diet]
+    if diet == "⚠️ Аллергии":
+        steps.append(", ".join(rng.sample(ALLERGIES, 2)))
+    ingredients = rng.sample(INGREDIENTS, rng.randint(2, 4))
+    if unique:
+        ingredients.append(f"{rng.randint(1, 10 ** 9)}г соли")
+    steps.append(", ".join(ingredients))
+    return steps
+
+
+async def run_user(session, webhook_url: str, sink: TelegramSink, kitchen, chat_id: int,
+                   rng: random.Random, args, update_ids, results: dict):
+    steps = wizard_flow(kitchen, rng, args.unique)
+    for index, text in enumerate(steps):
+        last = index == len(steps) - 1
+        already_sent = len(sink.sent(chat_id))
+        started = time.perf_counter()
+        async with session.post(webhook_url, json=make_update(next(update_ids), chat_id, text)) as response:
+            results["webhook_status"][response.status] = results["webhook_status"].get(response.status, 0) + 1
+        results["updates"] += 1
+
+        if last:
+            def predicate(sent):
+                return any(item[2] in FINAL_REPLIES for item in sent[already_sent:])
+        else:
+            def predicate(sent):
+                return len(sent) > already_sent
+        try:
+            sent = await sink.wait(chat_id, predicate, args.timeout)
+        except asyncio.TimeoutError:
+            results["timeouts"] += 1
+            return
+        finished = time.perf_counter()
+        first_reply = next(item[0] for item in sent[already_sent:])
+        results["step_latency"].append(first_reply - started)
+        if last:
+            results["recipe_latency"].append(finished - started)
+            if any(item[2] == FINAL_REPLIES[1] for item in sent[already_sent:]):
+                results["failed_recipes"] += 1
+        if args.think_ms:
+            await asyncio.sleep(rng.expovariate(1000 / args.think_ms))
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    yandex_port, telegram_port, bot_port = free_port(), free_port(), free_port()
+
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCHMARKBENCHMARKBENCHMARKBENCHMARK")
+    os.environ.setdefault("YANDEX_API_KEY", "benchmark")
+    os.environ.setdefault("YANDEX_FOLDER_ID", "benchmark")
+    os.environ.setdefault("WEBHOOK_URL", f"http://127.0.0.1:{bot_port}")
+    os.environ["YANDEX_GPT_URL"] = f"http://127.0.0.1:{yandex_port}/foundationModels/v1/completion"
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{telegram_port}"
+    os.environ.setdefault("STATE_BACKEND", "memory")
+    os.environ.setdefault("RECIPE_DB_PATH", "")
+
+    import AI_Kitchen_bot as kitchen
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+    stub = YandexStub(rng, args.llm_latency_ms, args.llm_jitter, args.llm_error_rate,
+                      args.llm_429_rate, args.llm_retry_after, args.recipe_length)
+    yandex_app = web.Application()
+    yandex_app.router.add_post("/foundationModels/v1/completion", stub.completion)
+
+    sink = TelegramSink()
+    telegram_app = web.Application()
+    telegram_app.router.add_post("/bot{token}/{method}", sink.handle)
+
+    kitchen_app = kitchen.create_app()
+    kitchen.get_yandex_client()
+    kitchen.update_queue.start()
+
+    runners = []
+    for application, port in ((yandex_app, yandex_port), (telegram_app, telegram_port), (kitchen_app, bot_port)):
+        runner = web.AppRunner(application, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+
+    results = {
+        "updates": 0, "timeouts": 0, "failed_recipes": 0, "webhook_status": {},
+        "step_latency": [], "recipe_latency": []
+    }
+    update_ids = itertools.count(1)
+    user_rngs = [random.Random(rng.random()) for _ in range(args.users)]
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def user(index: int):
+        async with limit:
+            await run_user(session, f"http://127.0.0.1:{bot_port}/webhook", sink, kitchen,
+                           100000 + index, user_rngs[index], args, update_ids, results)
+
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    try:
+        async with ClientSession() as session:
+            await asyncio.gather(*(user(index) for index in range(args.users)))
+    finally:
+        elapsed = time.perf_counter() - started
+        rss_after = rss_mb()
+        await kitchen.update_queue.stop()
+        for runner in reversed(runners):
+            await runner.cleanup()
+        await kitchen.close_yandex_client()
+        await kitchen.bot.session.close()
+
+    step, recipe = results["step_latency"], results["recipe_latency"]
+    return {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "seed": args.seed,
+        "elapsed_s": round(elapsed, 3),
+        "updates": results["updates"],
+        "updates_per_s": round(results["updates"] / elapsed, 2) if elapsed else 0.0,
+        "step_latency_ms": {q: round(percentile(step, v) * 1000, 1) for q, v in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "recipe_latency_ms": {q: round(percentile(recipe, v) * 1000, 1) for q, v in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "recipes": len(recipe),
+        "failed_recipes": results["failed_recipes"],
+        "timeouts": results["timeouts"],
+        "webhook_status": {str(k): v for k, v in results["webhook_status"].items()},
+        "llm": {"requests": stub.requests, "errors": stub.errors, "throttled": stub.throttled},
+        "telegram_calls": sink.calls,
+        "cache": kitchen.recipe_cache.stats(),
+        "rss_mb": {"before": round(rss_before, 1), "after": round(rss_after, 1), "growth": round(rss_after - rss_before, 1)}
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    if report["updates_per_s"] < baseline["updates_per_s"] * (1 - tolerance):
+        regressions.append(f"updates/s: {report['updates_per_s']} < {baseline['updates_per_s']}")
+    for key in ("step_latency_ms", "recipe_latency_ms"):
+        for q in ("p95", "p99"):
+            if report[key][q] > baseline[key][q] * (1 + tolerance):
+                regressions.append(f"{key} {q}: {report[key][q]} > {baseline[key][q]}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест AI Kitchen Bot с локальными заглушками")
+    parser.add_argument("--users", type=int, default=200, help="сколько пользователей проходят сценарий")
+    parser.add_argument("--concurrency", type=int, default=50, help="сколько пользователей активны одновременно")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--unique", action="store_true", help="уникальные ингредиенты у каждого, чтобы не попадать в кэш")
+    parser.add_argument("--think-ms", type=float, default=0, help="средняя пауза пользователя между шагами")
+    parser.add_argument("--timeout", type=float, default=120, help="сколько ждать ответа бота на шаг (сек)")
+    parser.add_argument("--llm-latency-ms", type=float, default=800, help="медианная задержка YandexGPT")
+    parser.add_argument("--llm-jitter", type=float, default=0.5, help="сигма логнормального разброса задержки")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--llm-429-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--llm-retry-after", type=float, default=1.0, help="Retry-After в ответах 429 (сек)")
+    parser.add_argument("--recipe-length", type=int, default=1500, help="длина сгенерированного рецепта")
+    parser.add_argument("--output", help="сохранить отчёт в JSON")
+    parser.add_argument("--baseline", help="JSON-отчёт прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение относительно baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"РЕГРЕССИЯ: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
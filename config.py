@@ -35,4 +35,3 @@ class BotConfig:
 
 
 config = BotConfig()
-config.validate()